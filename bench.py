@@ -0,0 +1,152 @@
+from modularcut import *
+from functions import *
+from main import filterIsomorphicConnectivities, streamIsomorphicConnectivities, \
+    streamExtensions, streamAugmentations
+from collections import Counter
+import argparse
+import json
+import sys
+import time
+
+# Benchmarks each stage of a generation separately, level by level from TWO,
+# and checks the counts found against the golden counts of earlier runs
+
+# For the generation with |E| = n: the cuts of the parents, those that are
+# connected and unitary, and the non-isomorphic extensions
+GOLDEN = {
+    3: {"cuts": 6, "kept": 1, "classes": 1},
+    4: {"cuts": 20, "kept": 8, "classes": 4},
+    5: {"cuts": 171, "kept": 51, "classes": 7},
+    6: {"cuts": 2487, "kept": 1780, "classes": 57},
+    7: {"classes": 284},
+}
+
+# listCuts closes every family of subsets, so it is only timed on parents
+# with at most this many elements
+LIST_LIMIT = 3
+
+# Stages faster than this are too noisy to flag as regressions
+NOISE = 0.05
+
+def timed(stage, n, function, count=None, expected=None):
+    """Runs function, returning its result and a record of the stage. The
+       count of the record is found from the result by count"""
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    record = {"n": n, "stage": stage, "seconds": round(seconds, 6)}
+    if count is not None:
+        record["count"] = count(result)
+        record["expected"] = expected
+        record["ok"] = expected is None or record["count"] == expected
+    return result, record
+
+def benchmarkLevel(parents, n, listLimit=LIST_LIMIT):
+    """Benchmarks extending parents to the generation with |E| = n. Returns
+       the representatives found and a list of records"""
+    golden = GOLDEN.get(n, {})
+    records = []
+
+    def record(stage, function, count=None, key=None):
+        result, entry = timed(stage, n, function, count, golden.get(key))
+        records.append(entry)
+        return result
+
+    if len(parents[0].groundset) <= listLimit:
+        record("listCuts", lambda: [set(cut.cut for cut in listCuts(parent)) for parent in parents],
+               lambda found: sum(len(cuts) for cuts in found), "cuts")
+
+    cuts = record("enumerateCuts",
+                  lambda: [(parent, list(enumerateCuts(parent))) for parent in parents],
+                  lambda found: sum(len(parentCuts) for parent, parentCuts in found), "cuts")
+
+    record("populateCut",
+           lambda: [ModularCut(cut.cut, parent) for parent, parentCuts in cuts for cut in parentCuts],
+           len, "cuts")
+
+    kept = record("connectedCuts/unitaryCuts",
+                  lambda: [(parent, unitaryCuts(connectedCuts(parentCuts))) for parent, parentCuts in cuts],
+                  lambda found: sum(len(parentCuts) for parent, parentCuts in found), "kept")
+
+    extensions = record("modularCutExtension",
+                        lambda: [modularCutExtension(cut, parent) for parent, parentCuts in kept
+                                 for cut in parentCuts],
+                        len, "kept")
+
+    representatives = record("filterIsomorphicConnectivities",
+                             lambda: filterIsomorphicConnectivities(extensions), len, "classes")
+
+    # Every extension is isomorphic to exactly one representative
+    record("isomorphicTo",
+           lambda: [sum(1 for rep in representatives if extension.isomorphicTo(rep))
+                    for extension in extensions],
+           lambda matches: sum(matches) if all(match == 1 for match in matches) else -1, "kept")
+
+    # The pipelines of main.py, end to end
+    record("streamExtensions",
+           lambda: list(streamIsomorphicConnectivities(streamExtensions(parents, Counter()))),
+           len, "classes")
+    record("streamAugmentations",
+           lambda: list(streamAugmentations(parents, Counter())), len, "classes")
+
+    return representatives, records
+
+def runBenchmarks(last, listLimit=LIST_LIMIT):
+    """Benchmarks every level from TWO up to |E| = last, returning the records"""
+    parents = [TWO]
+    records = []
+    for n in range(len(TWO.groundset) + 1, last + 1):
+        start = time.perf_counter()
+        parents, levelRecords = benchmarkLevel(parents, n, listLimit)
+        records.extend(levelRecords)
+        records.append({"n": n, "stage": "total",
+                        "seconds": round(time.perf_counter() - start, 6)})
+    return records
+
+def regressions(records, baseline, threshold):
+    """Records slower than threshold times the same stage of baseline, for
+       stages the baseline took longer than NOISE seconds on"""
+    before = {(record["n"], record["stage"]): record["seconds"] for record in baseline}
+    slower = []
+    for record in records:
+        previous = before.get((record["n"], record["stage"]))
+        if previous is not None and previous > NOISE and record["seconds"] > threshold * previous:
+            slower.append(dict(record, baseline=previous))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks each stage of the enumeration against golden counts")
+    parser.add_argument("--last", type=int, default=6,
+                        help="largest |E| to benchmark")
+    parser.add_argument("--list-limit", type=int, default=LIST_LIMIT,
+                        help="largest parent |E| to time listCuts on")
+    parser.add_argument("--output", default=None,
+                        help="file to write the records to as JSON lines")
+    parser.add_argument("--baseline", default=None,
+                        help="JSON lines of an earlier run to compare timings with")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown over the baseline counted as a regression")
+    args = parser.parse_args()
+
+    records = runBenchmarks(args.last, args.list_limit)
+    lines = [json.dumps(record) for record in records]
+    if args.output is None:
+        print("\n".join(lines))
+    else:
+        with open(args.output, "w") as out:
+            out.write("\n".join(lines) + "\n")
+
+    failed = False
+    for record in records:
+        if not record.get("ok", True):
+            print("Wrong count: " + json.dumps(record), file=sys.stderr)
+            failed = True
+    if args.baseline is not None:
+        with open(args.baseline) as previous:
+            baseline = [json.loads(line) for line in previous if line.strip()]
+        for record in regressions(records, baseline, args.threshold):
+            print("Regression: " + json.dumps(record), file=sys.stderr)
+            failed = True
+    sys.exit(1 if failed else 0)
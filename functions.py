@@ -1,91 +1,407 @@
-from itertools import combinations, product, permutations, chain
-from helper import powerset
-import networkx as nx
+from itertools import combinations, product, chain
+from helper import subsetTable, members
+from functools import lru_cache
+from array import array
+import instrument
+import sys
 import itertools as it
-import matplotlib.pyplot as plt
 
 # Class definitions for SetFunction, Connectivity, Polymatroid
 
+# Number of subsets from which modular pair indexes are built with NumPy
+VECTORIZE_SIZE = 64
+
+# Graphs are built on first access unless this is set before construction
+EAGER_GRAPHS = False
+
+def modularRows(values):
+    """Modular pair rows of a value vector indexed by bitmask, as integers,
+       computed as one vectorized comparison over all pairs of bitmasks"""
+    import numpy as np
+    v = np.asarray(values, dtype=np.int64)
+    masks = np.arange(len(v))
+    meets = masks[:, None] & masks
+    joins = masks[:, None] | masks
+    pairs = v[:, None] + v == v[meets] + v[joins]
+    packed = np.packbits(pairs, axis=1, bitorder='little')
+    return [int.from_bytes(row.tobytes(), 'little') for row in packed]
+
+# Rows are checked this many at a time by the batch checks, to bound the
+# size of the intermediate arrays
+BATCH_ROWS = 4096
+
+def batchRows(matrix, check):
+    """Applies check to the rows of a (count, 2^n) value matrix a block at a
+       time, as int32 so sums cannot overflow, and returns the boolean mask"""
+    import numpy as np
+    matrix = np.asarray(matrix)
+    result = np.empty(len(matrix), dtype=bool)
+    for start in range(0, len(matrix), BATCH_ROWS):
+        block = np.asarray(matrix[start:start + BATCH_ROWS], dtype=np.int32)
+        result[start:start + BATCH_ROWS] = check(block)
+    return result
+
+@lru_cache(maxsize=None)
+def squareIndices(n):
+    """The bitmasks S, S+i, S+j and S+i+j of every elementary square, as
+       four NumPy index arrays"""
+    import numpy as np
+    table = subsetTable(tuple(range(n)))
+    low, left, right, high = [], [], [], []
+    for m in range(len(table.sets)):
+        for (i, j) in table.squares[m]:
+            low.append(m)
+            left.append(m | i)
+            right.append(m | j)
+            high.append(m | i | j)
+    return tuple(np.array(corner, dtype=np.intp) for corner in (low, left, right, high))
+
+def batchNormal(matrix):
+    """Mask of the rows of a value matrix with no negative values"""
+    return batchRows(matrix, lambda v: (v >= 0).all(axis=1))
+
+def batchSubmodular(matrix):
+    """Mask of the submodular rows of a (count, 2^n) value matrix"""
+    n = (matrix.shape[1] - 1).bit_length()
+    low, left, right, high = squareIndices(n)
+    return batchRows(matrix, lambda v:
+                     (v[:, left] + v[:, right] >= v[:, low] + v[:, high]).all(axis=1))
+
+def batchSymmetric(matrix):
+    """Mask of the symmetric rows of a value matrix. The complement of
+       bitmask m is full ^ m = full - m, so reversing a row complements it"""
+    return batchRows(matrix, lambda v: (v == v[:, ::-1]).all(axis=1))
+
+def batchUnitary(matrix):
+    """Mask of the rows of a value matrix assigning 1 to every singleton"""
+    n = (matrix.shape[1] - 1).bit_length()
+    singletons = [1 << i for i in range(n)]
+    return batchRows(matrix, lambda v: (v[:, singletons] == 1).all(axis=1))
+
+def batchConnected(matrix):
+    """Mask of the rows of a value matrix assigning 0 to no non-trivial set"""
+    return batchRows(matrix, lambda v: (v[:, 1:-1] != 0).all(axis=1))
+
+def closureMasks(values):
+    """Closure of every bitmask of a value vector, the bits x with
+       f(m + x) == f(m), computed as one vectorized comparison per element"""
+    import numpy as np
+    v = np.asarray(values)
+    masks = np.arange(len(v))
+    closures = np.zeros(len(v), dtype=np.int64)
+    bit = 1
+    while bit < len(v):
+        closures[v[masks | bit] == v] |= bit
+        bit <<= 1
+    return closures.tolist()
+
+def packValues(values):
+    """Packs a value vector into bytes, one byte per value when they fit"""
+    if all(-128 <= value < 128 for value in values):
+        return array('b', values).tobytes()
+    return array('i', values).tobytes()
+
+def unpackFunction(cls, elements, packed, canonical):
+    """Rebuilds a SetFunction pickled by SetFunction.__reduce__"""
+    values = array('b' if len(packed) == 1 << len(elements) else 'i')
+    values.frombytes(packed)
+    function = cls.from_values(array('i', values), elements)
+    function._canonical = canonical
+    return function
+
 # Submodular, Normal set function
 class SetFunction:
-    """A Submodular and Normalized function from Sets to Integers"""
+    """A Submodular and Normalized function from Sets to Integers.
+
+    Values are stored in a flat array indexed by subset bitmask, where bit i
+    stands for the i-th smallest element of the ground set."""
+    __slots__ = ('groundset', 'table', 'values', '_modular', '_canonical',
+                 '_labeling', '_fingerprint', '_graph')
 
     def __init__(self, mapping, groundset):
-        """Initializer takes a dictionary (mapping) and a set (groundset)"""
+        """Initializer takes a dictionary (mapping) and a set (groundset).
+           The mapping may also be a sequence of values indexed by bitmask"""
         self.groundset = frozenset(groundset)
-        self.subsets = [frozenset(s) for s in powerset(groundset)]
-        self.mapping = mapping
+        self.table = subsetTable(tuple(sorted(self.groundset)))
+        if isinstance(mapping, dict):
+            values = array('i', [0]) * len(self.table.sets)
+            for sub, value in mapping.items():
+                values[self.table.maskOf[frozenset(sub)]] = value
+            mapping = values
+        self.values = mapping
+        self._modular = None
+        self._canonical = None
+        self._labeling = None
+        self._fingerprint = None
+        self._graph = None
+
+    @classmethod
+    def from_values(cls, values, groundset):
+        """Constructor from a sequence of values indexed by bitmask"""
+        return cls(values, groundset)
+
+    def __reduce__(self):
+        """Pickles as the packed value vector and the canonical form, if
+           known, leaving out the other caches"""
+        return (unpackFunction, (self.__class__, self.table.elements,
+                                 packValues(self.values), self._canonical))
+
+    @property
+    def graph(self):
+        """The isomorphism invariant graph, built on first access"""
+        if self._graph is None:
+            self._graph = self.buildGraph()
+        return self._graph
+
+    @property
+    def subsets(self):
+        """All subsets of the ground set, in powerset order"""
+        return self.table.subsets
+
+    @property
+    def mapping(self):
+        """The function as a dictionary from subsets to values"""
+        return {sub: self.values[m]
+                for sub, m in zip(self.table.subsets, self.table.masks)}
 
     def __str__(self):
         """Prints the SetFunction"""
-        #string = "Ground Set: \n\t" + str([s for s in self.groundset]) + "\n"
-        #string = "Function: \n"
-        graph = sorted([(k, v) for k, v in self.mapping.items()],
-                       key = lambda x: x[1])
-
-        curr = 0
-        string = "0:\t"
-        for (k, v) in graph:
-            if v > curr:
-                curr = v
-                string += "\n" + str(v) + ":\t"
-                string += str([s for s in k]) + " "
-            else:
-                string += str([s for s in k]) + " "
-        string += "\n"
-                
-        return string
+        # The subsets are listed by increasing value, those of value at
+        # most 0 on the first line, each in powerset order
+        v = self.values
+        levels = {}
+        for sub, m in zip(self.table.subsets, self.table.masks):
+            levels.setdefault(v[m], []).append(sub)
+
+        parts = ["0:\t"]
+        for value in sorted(levels):
+            if value > 0:
+                parts.append("\n" + str(value) + ":\t")
+            parts.extend(str(list(sub)) + " " for sub in levels[value])
+        parts.append("\n")
+        return "".join(parts)
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            if len(self.groundset) == len(other.groundset):
-                for sub in self.subsets:
-                    if self.function(sub) != other.function(sub):
-                        return False
-                return True
+            if self.groundset == other.groundset:
+                return tuple(self.values) == tuple(other.values)
+        return False
+
+    def mask(self, A):
+        """The bitmask of the subset A"""
+        try:
+            return self.table.maskOf[A]
+        except (KeyError, TypeError):
+            if not (A <= self.groundset):
+                raise Exception(str(A) + " isn't in " + str(self.groundset))
+            return self.table.maskOf[frozenset(A)]
 
     def function(self, A):
         """Apply the Set Function to the subset A"""
-        if not (A <= self.groundset):
-            raise Exception(str(A) + " isn't in " + str(self.groundset))
-        return self.mapping[A]
+        return self.values[self.mask(A)]
 
     def isNormal(self):
         """True if the function is Normal"""
-        for A in self.subsets:
-            if self.function(A) < 0:
+        for value in self.values:
+            if value < 0:
                 return False
         return True
     
     def isSubmodular(self):
-        """True if the function is Submodular"""
-        triples = product(self.subsets, 3)
-        E = groundset
-        for (A, B, C) in triples:
-            LHS = self.function(A) + self.function(B) + self.function(B)
-            RHS = self.function(A&(E-B)&(E-C)) + \
-                self.function((E-A)&B&(E-C)) + \
-                self.function((E-A)&(E-B)&C)
-            if LHS < RHS:
-                return False
+        """True if the function is Submodular. It is enough to check
+           f(S+i) + f(S+j) >= f(S) + f(S+i+j) for i, j outside S"""
+        v = self.values
+        for m in range(len(v)):
+            for (i, j) in self.table.squares[m]:
+                if v[m | i] + v[m | j] < v[m] + v[m | i | j]:
+                    return False
         return True
 
     def modular(self, p0, p1):
         """True if p0 and p1 are a modular pair"""
-        return (self.function(p0) + self.function(p1) == 
-                self.function(p0 & p1) + self.function(p0 | p1))
-    
+        return self.modularMasks(self.mask(p0), self.mask(p1))
+
+    def modularMasks(self, m0, m1):
+        """True if the subsets with bitmasks m0 and m1 are a modular pair"""
+        if instrument.ENABLED:
+            instrument.count("modular")
+        v = self.values
+        return v[m0] + v[m1] == v[m0 & m1] + v[m0 | m1]
+
+    def modularPartners(self, m):
+        """The family of subsets forming a modular pair with bitmask m, as an
+           integer with a bit set for each member bitmask. Rows are computed
+           on first use and kept for the lifetime of the function"""
+        if self._modular is None:
+            self._modular = [None] * len(self.values)
+        row = self._modular[m]
+        if row is None:
+            v = self.values
+            if instrument.ENABLED:
+                instrument.count("modular", len(v))
+            row = 0
+            for k in range(len(v)):
+                if v[m] + v[k] == v[m & k] + v[m | k]:
+                    row |= 1 << k
+            self._modular[m] = row
+        return row
+
+    def modularIndex(self):
+        """The rows of modularPartners for every bitmask, built all at once.
+           From VECTORIZE_SIZE subsets on, the rows are built with NumPy"""
+        if self._modular is None or None in self._modular:
+            rows = None
+            if len(self.values) >= VECTORIZE_SIZE:
+                try:
+                    rows = modularRows(self.values)
+                except ImportError:
+                    pass
+            if rows is not None:
+                self._modular = rows
+                if instrument.ENABLED:
+                    instrument.count("modular", len(self.values) ** 2)
+            else:
+                for m in range(len(self.values)):
+                    self.modularPartners(m)
+        return self._modular
+
+    def modularIndexBytes(self):
+        """Memory held by the modular pair rows built so far, in bytes"""
+        if self._modular is None:
+            return 0
+        return sys.getsizeof(self._modular) + \
+            sum(sys.getsizeof(row) for row in self._modular if row is not None)
+
+    def elementInvariants(self):
+        """Lists, for each bit of the ground set, the value of the singleton
+           and the sorted values of the pairs containing it"""
+        v = self.values
+        bits = self.table.bits
+        return [(v[b], tuple(sorted(v[b | c] for c in bits if c != b)))
+                for b in bits]
+
+    def isTransposition(self, i, j):
+        """True if swapping the elements with bits i and j is an automorphism"""
+        v = self.values
+        both = i | j
+        for m in range(len(v)):
+            if (m & both) == i and v[m] != v[m ^ both]:
+                return False
+        return True
+
+    def fingerprint(self):
+        """Isomorphism invariants that are cheap to compare: the histogram of
+           values per subset size, the multiset of per-element stability
+           profiles and the number of modular elementary squares.
+           Isomorphic functions have equal fingerprints"""
+        if self._fingerprint is None:
+            v = self.values
+            bits = self.table.bits
+            sizes = self.table.sizes
+            masks = range(len(v))
+
+            levels = tuple(sorted(zip(sizes, v)))
+
+            # How adding x to A of each size changes the value: down, same, up
+            profiles = tuple(sorted(
+                tuple(sorted([(sizes[m], (v[m | b] > v[m]) - (v[m | b] < v[m]))
+                              for m in without]))
+                for b, without in zip(bits, self.table.without)))
+
+            # Modular pairs among the elementary squares A+x, A+y
+            pairs = 0
+            for m in masks:
+                for x, y in self.table.squares[m]:
+                    if v[m | x] + v[m | y] == v[m] + v[m | x | y]:
+                        pairs += 1
+
+            self._fingerprint = (levels, profiles, pairs)
+        return self._fingerprint
+
+    def canonicalForm(self):
+        """The lexicographically smallest value vector over the relabelings
+           ordered by element invariants, those placing the elements by
+           increasing elementInvariants. This is not the smallest over all
+           relabelings, but two functions are still isomorphic exactly when
+           they have the same canonical form"""
+        if self._canonical is None:
+            self._canonical, self._labeling = self.canonicalSearch()
+        return self._canonical
+
+    def canonicalLabeling(self):
+        """The bits of the elements placed at each position by a relabeling
+           that gives the canonical form. It is found with the form, and
+           both are kept"""
+        if self._labeling is None:
+            self._canonical, self._labeling = self.canonicalSearch()
+        return self._labeling
+
+    def canonicalSearch(self):
+        """Builds the canonical form one position at a time, keeping only the
+           partial relabelings whose values so far are minimal. Returns the
+           form and the bits placed at each position by one such relabeling"""
+        if instrument.ENABLED:
+            instrument.count("canonical")
+        v = self.values
+        bits = self.table.bits
+        n = len(bits)
+
+        # Position k may only take an element with the k-th smallest
+        # invariant, which keeps the minimum isomorphism invariant
+        invariants = self.elementInvariants()
+        cells = sorted(invariants)
+
+        # Of a group of interchangeable elements only the first unused one
+        # needs to be tried, the others give the same values
+        candidates = []
+        for k in range(n):
+            cell = []
+            for i in range(n):
+                if invariants[i] == cells[k]:
+                    earlier = 0
+                    for j in range(i):
+                        if invariants[j] == invariants[i] and \
+                           self.isTransposition(bits[j], bits[i]):
+                            earlier |= bits[j]
+                    cell.append((bits[i], earlier))
+            candidates.append(cell)
+
+        # A partial relabeling is the set of used elements, and image[m]
+        # holds the original bitmask placed at position bitmask m
+        form = [v[0]]
+        partials = [(0, [0])]
+        for k in range(n):
+            best = None
+            extended = []
+            for used, image in partials:
+                for bit, earlier in candidates[k]:
+                    if used & bit or used & earlier != earlier:
+                        continue
+                    block = [v[m | bit] for m in image]
+                    if best is None or block < best:
+                        best = block
+                        extended = []
+                    if block == best:
+                        extended.append((used | bit,
+                                         image + [m | bit for m in image]))
+            form.extend(best)
+            partials = extended
+        image = partials[0][1]
+        return tuple(form), [image[1 << k] for k in range(n)]
+
     def isValid(self):
         """True if the function is Normal and Submodular"""
-        return self.isNormal() and self.isSubmodular
+        return self.isNormal() and self.isSubmodular()
 
 class Connectivity(SetFunction):
     """Connectivity system"""
+    __slots__ = ()
 
     def __init__(self, mapping, groundset):
         """Takes a dictionary (mapping) and a set (groundset)"""
         super().__init__(mapping, groundset)
-        self.graph = self.graph()
+        if EAGER_GRAPHS:
+            self._graph = self.buildGraph()
 
     @classmethod
     def from_poly(cls, polymatroid):
@@ -95,14 +411,17 @@ class Connectivity(SetFunction):
         for sub in polymatroid.subsets:
             connMapping[sub] = polymatroid.function(sub) - len(sub)
         super(cls, conn).__init__(connMapping, polymatroid.groundset)
-        conn.graph = conn.graph()
+        if EAGER_GRAPHS:
+            conn._graph = conn.buildGraph()
         return conn
 
     def isSymmetric(self):
         """True if the value assigned to every set is the same as the value
            assigned to it's complement"""
-        for A in self.subsets:
-            if self.function(A) != self.function(self.groundset - A):
+        v = self.values
+        full = len(v) - 1
+        for m in range(len(v)):
+            if v[m] != v[full ^ m]:
                 return False
         return True
 
@@ -112,17 +431,17 @@ class Connectivity(SetFunction):
 
     def isUnitary(self):
         """True if all singletons are assigned the value 1"""
-        for v in self.groundset:
-            if self.function(set([v])) != 1:
+        for b in self.table.bits:
+            if self.values[b] != 1:
                 return False
         return True
 
     def isConnected(self):
         """True if no non-trivial subsets are assigned the value 0"""
-        for s in self.subsets:
-            if s != frozenset() and s != self.groundset:
-                if self.function(s) == 0:
-                    return False
+        v = self.values
+        for m in range(1, len(v) - 1):
+            if v[m] == 0:
+                return False
         return True
    
 
@@ -139,28 +458,119 @@ class Connectivity(SetFunction):
         if self.function(A) < self.function(A | x): return 1
 
     def isomorphicTo(self, other):
-        """Uses the permutations of the ground set to check isomorphism"""
-        def relabel(perm, sub):
-            """Relabels the subset according to the permutation given"""
-            out = frozenset()
-            for e in sub:
-                out = out | set([perm[e]])
-            return out
-        
-        ground = sorted(list(self.groundset))
-        perms = list(permutations(ground))
-        for perm in perms:
-            iso = True
-            for sub in self.subsets:
-                if self.function(relabel(perm, sub)) != other.function(sub):
-                    iso = False
-                    break
-            if iso:
-                return True
-        return False
-        
-    def graph(self):
+        """Searches the relabelings of the ground set to check isomorphism"""
+        if instrument.ENABLED:
+            instrument.count("isomorphisms")
+        if self.fingerprint() != other.fingerprint():
+            return False
+        return next(self.isomorphisms(other), None) is not None
+
+    def isomorphisms(self, other, fixed=None):
+        """Yields every relabeling perm mapping this function onto other, as
+           a list sending bit i of other to bit perm[i] of this function.
+           If fixed is given, only relabelings sending each bit i in fixed
+           to bit fixed[i] are yielded.
+
+           Elements of other are assigned one at a time, each only to elements
+           with the same invariants, and a partial map is dropped as soon as
+           a subset it fully determines gets a different value"""
+        v = self.values
+        w = other.values
+        n = len(self.table.bits)
+        if len(v) != len(w) or v[0] != w[0]:
+            return
+        mine = self.elementInvariants()
+        theirs = other.elementInvariants()
+        targets = [[t for t in range(n) if mine[t] == theirs[i]]
+                   for i in range(n)]
+        for i, t in (fixed or {}).items():
+            targets[i] = [t] if t in targets[i] else []
+
+        # image[m] is the bitmask of the image of subset m of other
+        image = [0] * len(v)
+        perm = [0] * n
+        counting = instrument.ENABLED
+
+        def extend(i, used):
+            if i == n:
+                yield list(perm)
+                return
+            low = 1 << i
+            for t in targets[i]:
+                bit = 1 << t
+                if used & bit:
+                    continue
+                if counting:
+                    instrument.count("permutations")
+                # Only subsets whose largest element is i are new
+                for m in range(low):
+                    image[m | low] = image[m] | bit
+                    if v[image[m | low]] != w[m | low]:
+                        break
+                else:
+                    perm[i] = t
+                    yield from extend(i + 1, used | bit)
+
+        yield from extend(0, 0)
+
+    def automorphismGenerators(self):
+        """Returns a generating set of the automorphism group, leaving out
+           the identity. Each automorphism is given as the image of every
+           bitmask.
+
+           The generators are found level by level, Schreier-Sims style:
+           from the last element down, element k is sent to each element
+           outside its orbit under the generators so far by the first
+           automorphism found that fixes every element before k. Each one
+           found enlarges the group they generate, so there are at most
+           log2 |G| of them, and the group itself is never listed"""
+        n = len(self.table.bits)
+        invariants = self.elementInvariants()
+        generators = []
+        for k in reversed(range(n)):
+            fixed = {i: i for i in range(k)}
+            orbit = {k}
+            for t in range(k + 1, n):
+                if t in orbit or invariants[t] != invariants[k]:
+                    continue
+                fixed[k] = t
+                perm = next(self.isomorphisms(self, fixed), None)
+                if perm is None:
+                    continue
+                generators.append(tuple(perm))
+                # Every generator so far fixes 0, ..., k - 1, so together
+                # they move k within its orbit
+                frontier = list(orbit)
+                while frontier:
+                    x = frontier.pop()
+                    for g in generators:
+                        if g[x] not in orbit:
+                            orbit.add(g[x])
+                            frontier.append(g[x])
+
+        images = []
+        for perm in generators:
+            image = [0] * len(self.values)
+            for m in range(1, len(image)):
+                low = m & -m
+                image[m] = image[m ^ low] | 1 << perm[low.bit_length() - 1]
+            images.append(image)
+        return images
+
+    def inCanonicalOrbit(self, bit):
+        """True if an automorphism maps the element with this bit to the
+           element placed last by the canonical labeling. Those elements
+           form one orbit, the same for every isomorphic copy"""
+        last = self.canonicalLabeling()[-1]
+        if last == bit:
+            return True
+        fixed = {bit.bit_length() - 1: last.bit_length() - 1}
+        return next(self.isomorphisms(self, fixed), None) is not None
+
+    def buildGraph(self):
         """Finds the isomorphism invariant digraph for this function"""
+        import networkx as nx
+
         def getSubset(s0, s1):
             if s0 <= s1:
                 return (s0, s1)
@@ -212,38 +622,66 @@ ONE = Connectivity(
     
 class Polymatroid(SetFunction):
     """Polymatroid is a Set Function with the additional property Increasing"""
+    __slots__ = ('flatFamily',)
+
     def __init__(self, mapping, groundset):
         super().__init__(mapping, groundset)
-        self.flats = set({self.closure(A) for A in self.subsets})
-        self.nonflats = set(self.subsets) - self.flats
-        self.graph = self.graph()
+        self.flatFamily = self.findFlats()
+        if EAGER_GRAPHS:
+            self._graph = self.buildGraph()
 
     @classmethod
     def from_conn(cls, connectivity):
         """Constructor from Connectivity (connectivity)"""
-        poly = cls.__new__(cls)
-        
-        mapping = {}
-
-        for A in connectivity.subsets:
-            mapping[A] = sum([connectivity.function(frozenset([a])) for a in A]) + \
-                connectivity.function(A)
-            
-        super(cls, poly).__init__(mapping, connectivity.groundset)
-
-        poly.flats = set({poly.closure(A) for A in poly.subsets})
-        poly.nonflats = set(poly.subsets) - poly.flats
-        
-        poly.graph = poly.graph()
-        return poly
+        # The value of A is the sum of the values of its elements plus the
+        # connectivity of A, summed up one bit at a time
+        c = connectivity.values
+        weights = array('i', [0]) * len(c)
+        for m in range(1, len(c)):
+            low = m & -m
+            weights[m] = weights[m ^ low] + c[low]
+        values = array('i', [weights[m] + c[m] for m in range(len(c))])
+        return cls(values, connectivity.groundset)
+
+    @property
+    def flats(self):
+        """The flats as a set of frozensets"""
+        return {self.table.sets[m] for m in members(self.flatFamily)}
+
+    @property
+    def nonflats(self):
+        """The subsets that are not flats as a set of frozensets"""
+        nonflatFamily = ((1 << len(self.values)) - 1) ^ self.flatFamily
+        return {self.table.sets[m] for m in members(nonflatFamily)}
+
+    def closures(self):
+        """The bitmask of the closure of every bitmask"""
+        if len(self.values) >= VECTORIZE_SIZE:
+            try:
+                return closureMasks(self.values)
+            except ImportError:
+                pass
+        v = self.values
+        closures = [0] * len(v)
+        for m in range(len(v)):
+            for b in self.table.bits:
+                if v[m | b] == v[m]:
+                    closures[m] |= b
+        return closures
+
+    def findFlats(self):
+        """Returns the flats, the closures of all subsets, as an integer
+           family with bit m set for each flat bitmask m"""
+        family = 0
+        for m in set(self.closures()):
+            family |= 1 << m
+        return family
 
     def __str__(self):
         """Returns a string representation"""
         funcString = super().__str__()
-        flatInfo = ""
-        for flat in self.flats:
-            flatInfo += "Flat: " + str(flat) + ", rank: " + \
-                str(self.function(flat)) + "\n"
+        flatInfo = "".join("Flat: " + str(self.table.sets[m]) + ", rank: " + str(self.values[m]) + "\n"
+                           for m in members(self.flatFamily))
         return funcString + flatInfo
          
     def closure(self, A):
@@ -267,8 +705,91 @@ class Polymatroid(SetFunction):
         """True if Normalized, Submodular and Increasing"""
         return super().isValid() and self.isIncreasing()
 
-    def graph(self):
+    def refinedColors(self):
+        """Colour refinement (1-dimensional Weisfeiler-Lehman) of the graph
+           joining each element to the flats containing it, starting from
+           the colours of buildGraph. Colours are refined until the partition
+           they make stops growing, and are returned by node of that graph"""
+        bits = self.table.bits
+        flats = list(members(self.flatFamily))
+        elementColors = [-1] * len(bits)
+        flatColors = [self.values[flat] for flat in flats]
+        classes = 1 + len(set(flatColors))
+        while True:
+            elementColors = [hash((elementColors[i], tuple(sorted(
+                flatColors[k] for k, flat in enumerate(flats) if flat & bit))))
+                for i, bit in enumerate(bits)]
+            flatColors = [hash((flatColors[k], tuple(sorted(
+                elementColors[i] for i, bit in enumerate(bits) if flat & bit))))
+                for k, flat in enumerate(flats)]
+            refined = len(set(elementColors)) + len(set(flatColors))
+            if refined == classes:
+                break
+            classes = refined
+
+        colors = dict(zip(self.table.elements, elementColors))
+        colors.update(zip((self.table.sets[flat] for flat in flats), flatColors))
+        return colors
+
+    def matchesGraph(self, other, colors, otherColors):
+        """True if the graphs of the two polymatroids are isomorphic, given
+           the refined colours of both. Each flat is joined to exactly its
+           elements, so an isomorphism is fixed by where it sends the
+           elements. Elements are only sent to elements of the same colour,
+           and a partial map is dropped as soon as a flat within the mapped
+           elements is not sent to a flat of the same rank"""
+        counting = instrument.ENABLED
+        if counting:
+            instrument.count("isomorphisms")
+        n = len(self.table.bits)
+        if len(other.table.bits) != n or \
+           bin(self.flatFamily).count("1") != bin(other.flatFamily).count("1"):
+            return False
+        theirs = {}
+        for m in members(other.flatFamily):
+            theirs[m] = other.values[m]
+        # Flats are checked once their largest element is mapped
+        checks = [[] for i in range(n + 1)]
+        for m in members(self.flatFamily):
+            checks[m.bit_length()].append((m, self.values[m]))
+        targets = [[t for t in range(n)
+                    if otherColors[other.table.elements[t]] == colors[self.table.elements[i]]]
+                   for i in range(n)]
+        perm = [0] * n
+
+        def image(m):
+            mapped = 0
+            for i in members(m):
+                mapped |= 1 << perm[i]
+            return mapped
+
+        def extend(i, used):
+            if i == n:
+                return True
+            for t in targets[i]:
+                if used >> t & 1:
+                    continue
+                if counting:
+                    instrument.count("permutations")
+                perm[i] = t
+                if all(theirs.get(image(m)) == rank for m, rank in checks[i + 1]) \
+                   and extend(i + 1, used | 1 << t):
+                    return True
+            return False
+
+        return all(theirs.get(m) == rank for m, rank in checks[0]) and extend(0, 0)
+
+    def refinementHash(self, colors=None):
+        """Hash of the refined colours, computed unless given as colors.
+           Isomorphic polymatroids get the same hash"""
+        if colors is None:
+            colors = self.refinedColors()
+        return hash(tuple(sorted(colors.values())))
+
+    def buildGraph(self):
         """Returns the isomorphism invariant graph for this polymatroid"""
+        import networkx as nx
+
         G = nx.Graph()
 
         for e in self.groundset:
@@ -290,20 +811,23 @@ def colors_match(n1_attrib,n2_attrib):
     except KeyError:
         return False
     
+# Streams out isomorphic polymatroids, yielding the first of each class as
+# it arrives. Polymatroids are bucketed by the hash of their refined colours,
+# and graphs are only matched against the representatives in the same bucket
+def streamIsomorphicPolymatroids(polymatroids):
+    buckets = {}
+    for polymatroid in polymatroids:
+        with instrument.stage("filter"):
+            colors = polymatroid.refinedColors()
+            bucket = buckets.setdefault(polymatroid.refinementHash(colors), [])
+            new = not any(polymatroid.matchesGraph(rep, colors, repColors)
+                          for rep, repColors in bucket)
+            if new:
+                bucket.append((polymatroid, colors))
+        if new:
+            yield polymatroid
+
 # Filters out isomorphic polymatroids
 def filterIsomorphicPolymatroids(polymatroids):
-    reps = [polymatroids[0]]
-    for polymatroid in polymatroids:
-        newRep = True
-        GN = polymatroid.graph
-        for rep in reps:
-            GR = rep.graph
-            GM = nx.algorithms.isomorphism.GraphMatcher(GN, GR, node_match=colors_match)
-            if GM.is_isomorphic():
-                newRep = False
-                print("found isomorphic")
-                break
-        if newRep:
-            reps.append(polymatroid)            
-    return reps
+    return list(streamIsomorphicPolymatroids(polymatroids))
             
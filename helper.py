@@ -1,6 +1,7 @@
 # Helper functions and definitions that don't need to be anywhere else
 
 from itertools import chain, combinations
+from functools import lru_cache
 def powerset(iterable):
     "powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)"
     s = list(iterable)
@@ -8,6 +9,8 @@ def powerset(iterable):
 
 # Filters out isomorphic structures
 def filterIsomorphic(structures):
+    import networkx as nx
+
     representatives = [structures[0]]
     for structure in structures:
         newRepresentative = True
@@ -17,8 +20,50 @@ def filterIsomorphic(structures):
             DiGM = nx.algorithms.isomorphism.DiGraphMatcher(candidate, rep)
             if DiGM.is_isomorphic():
                 newRepresentative = False
-        if newRep:
+        if newRepresentative:
             representatives.append(structure)            
     return representatives
 
+# Subsets of a ground set encoded as integers, bit i standing for elements[i]
+class SubsetTable:
+    """Translates between the subsets of a ground set and their bitmasks"""
+    __slots__ = ('elements', 'bits', 'sets', 'sizes', 'subsets', 'masks',
+                 'maskOf', 'above', 'without', 'squares')
+
+    def __init__(self, elements):
+        """Takes the sorted tuple of elements of the ground set"""
+        self.elements = elements
+        self.bits = [1 << i for i in range(len(elements))]
+        self.sets = [frozenset(e for e, b in zip(elements, self.bits) if m & b)
+                     for m in range(1 << len(elements))]
+        self.sizes = [len(s) for s in self.sets]
+        self.subsets = [frozenset(s) for s in powerset(elements)]
+        self.maskOf = {s: m for m, s in enumerate(self.sets)}
+        self.masks = [self.maskOf[s] for s in self.subsets]
+        # above[m] is the family of the subsets with one element added to m,
+        # as an integer with a bit set for each member bitmask
+        self.above = [sum({1 << (m | b) for b in self.bits})
+                      for m in range(len(self.sets))]
+        # without[i] lists the subsets missing bit i, and squares[m] pairs
+        # up the bits outside m
+        self.without = [[m for m in range(len(self.sets)) if not (m & b)]
+                        for b in self.bits]
+        self.squares = [list(combinations([b for b in self.bits if not (m & b)], 2))
+                        for m in range(len(self.sets))]
+
+@lru_cache(maxsize=None)
+def subsetTable(elements):
+    """Returns the SubsetTable shared by every function on these elements"""
+    return SubsetTable(elements)
+
+def members(family):
+    """Yields the positions of the set bits of the integer family"""
+    while family:
+        low = family & -family
+        family ^= low
+        yield low.bit_length() - 1
 
+def complementFamily(family, size):
+    """The family of complements of the members of family, for a ground set
+       with size subsets. Complementing a bitmask reverses the bit order"""
+    return int(format(family, "0" + str(size) + "b")[::-1], 2)
@@ -0,0 +1,111 @@
+from collections import Counter
+from contextlib import nullcontext
+import sys
+import time
+
+# Optional instrumentation of the enumeration. Hot paths only count when
+# ENABLED is set, after a single check of it, so with it off they pay for
+# one attribute lookup per call. Counters are kept in total and for the
+# stage running when they are counted:
+#   closures       families closed by closeFamily
+#   passes         sets taken off the worklist of closeFamily
+#   modular        modular pair tests, one per pair of bitmasks
+#   permutations   partial relabelings tried by isomorphisms
+#   isomorphisms   isomorphism checks between two structures
+#   canonical      canonical forms computed
+# Each stage also keeps the peak RSS of the process when it last exited.
+# The peak never falls, so the stage it first rises in is the one that
+# grew the memory
+ENABLED = False
+
+counters = Counter()
+stages = {}
+active = None
+workerPeak = None
+
+NOTHING = nullcontext()
+
+def configure(enabled):
+    """Turns instrumentation on or off, clearing what was recorded"""
+    global ENABLED
+    ENABLED = enabled
+    reset()
+
+def reset():
+    """Clears what was recorded, keeping whether it is enabled"""
+    global workerPeak
+    counters.clear()
+    stages.clear()
+    workerPeak = None
+
+def count(name, amount=1):
+    """Adds amount to a counter, in total and for the active stage"""
+    counters[name] += amount
+    if active is not None:
+        stages[active]["counters"][name] += amount
+
+class Stage:
+    """Adds the wall time spent inside it to a stage, which counters are
+       also attributed to meanwhile, and records the peak RSS on leaving.
+       Stages may be entered many times"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        global active
+        stages.setdefault(self.name, {"seconds": 0.0, "peak_rss_kb": None,
+                                      "counters": Counter()})
+        self.previous = active
+        active = self.name
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        global active
+        entry = stages[self.name]
+        entry["seconds"] += time.perf_counter() - self.start
+        entry["peak_rss_kb"] = peakRSS()
+        active = self.previous
+        return False
+
+def stage(name):
+    """A context timing a stage, which does nothing when disabled"""
+    if not ENABLED:
+        return NOTHING
+    return Stage(name)
+
+def peakRSS():
+    """Peak resident set size of this process in kilobytes, or None where
+       the resource module is missing"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def snapshot():
+    """What was recorded, as plain dicts, with the peak RSS so far"""
+    return {"peak_rss_kb": peakRSS(),
+            "counters": dict(counters),
+            "stages": {name: {"seconds": round(entry["seconds"], 6),
+                              "peak_rss_kb": entry["peak_rss_kb"],
+                              "counters": dict(entry["counters"])}
+                       for name, entry in stages.items()}}
+
+def merge(recorded):
+    """Adds a snapshot taken in another process, such as a pool worker,
+       keeping the largest peak RSS of those processes in workerPeak"""
+    global workerPeak
+    if recorded["peak_rss_kb"] is not None:
+        workerPeak = max(workerPeak or 0, recorded["peak_rss_kb"])
+    counters.update(recorded["counters"])
+    for name, entry in recorded["stages"].items():
+        mine = stages.setdefault(name, {"seconds": 0.0, "peak_rss_kb": None,
+                                        "counters": Counter()})
+        mine["seconds"] += entry["seconds"]
+        if entry["peak_rss_kb"] is not None:
+            mine["peak_rss_kb"] = max(mine["peak_rss_kb"] or 0, entry["peak_rss_kb"])
+        mine["counters"].update(entry["counters"])
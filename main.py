@@ -1,43 +1,222 @@
 from modularcut import *
 from functions import *
 from helper import *
+from collections import Counter
+import argparse
+import instrument
+import json
+import os
+import store
+import sys
 import time
+import writer
 
-# Filters out isomorphic structures
-def filterIsomorphicConnectivities(structures):
-    representatives = [structures[0]]
+# Streams out isomorphic structures, yielding the first of each class as it
+# arrives. Structures are bucketed by fingerprint, and canonical forms are
+# only computed for buckets holding more than one structure. Only the
+# representatives are kept
+def streamIsomorphicConnectivities(structures):
+    buckets = {}
     for structure in structures:
-        newRepresentative = True
-        for representative in representatives:
-            if structure.isomorphicTo(representative):
-                newRepresentative = False
-        if newRepresentative:
-            representatives.append(structure)     
-    return representatives
+        with instrument.stage("filter"):
+            bucket = buckets.setdefault(structure.fingerprint(), [])
+            form = structure.canonicalForm() if bucket else None
+            new = not any(rep.canonicalForm() == form for rep in bucket)
+            if new:
+                bucket.append(structure)
+        if new:
+            yield structure
+
+# Filters out isomorphic structures, keeping the first of each class
+def filterIsomorphicConnectivities(structures):
+    return list(streamIsomorphicConnectivities(structures))
+
+# Streams out isomorphic structures through their polymatroids, whose graphs
+# of flats are compared instead of relabeled value vectors
+def streamIsomorphicByPolymatroids(structures):
+    def polymatroids():
+        for structure in structures:
+            with instrument.stage("filter"):
+                poly = Polymatroid.from_conn(structure)
+            yield poly
+
+    for poly in streamIsomorphicPolymatroids(polymatroids()):
+        with instrument.stage("filter"):
+            system = Connectivity.from_poly(poly)
+        yield system
+
+# Streams the extensions of each parent: the enumeration only yields
+# connected, unitary cuts, elision ones too if asked, of which one per orbit
+# under the automorphisms of the parent is kept, and each parent is extended
+# by all of those at once. The numbers of cuts found and kept are added to
+# counts. The cuts of a parent are kept as integers, which the orbits hold
+# anyway, while the children are yielded as each block of them is built
+def streamExtensions(previousgen, counts, elision=False):
+    for parent in previousgen:
+        with instrument.stage("cuts"):
+            found = list(cutFamilies(parent, connected=True, unitary=True, elision=elision))
+            cuts = list(orbitRepresentatives(parent, found))
+        counts["cuts"] += len(found)
+        counts["kept"] += len(cuts)
+        children = cutExtensions(parent, cuts)
+        while True:
+            # Only building the children counts as the extensions stage
+            with instrument.stage("extensions"):
+                child = next(children, None)
+            if child is None:
+                break
+            yield child
+
+# Streams the children whose new element, the highest bit, lies in their
+# canonical orbit. A child extended by an elision cut gives back its parent
+# as the least of the values of s and s + e, for every s not containing the
+# new element e, and every child arises from such a parent. As the parents
+# are pairwise non-isomorphic and extended by one cut per orbit, each
+# isomorphism class is produced exactly once, without comparing children
+def streamAugmentations(previousgen, counts):
+    for child in streamExtensions(previousgen, counts, elision=True):
+        with instrument.stage("augmentation"):
+            canonical = child.inCanonicalOrbit(1 << (len(child.groundset) - 1))
+        if canonical:
+            yield child
+
+# Augments each parent in a chunk. Runs in a worker process, and needs no
+# other chunk to decide which children to keep
+def augmentChunk(parents):
+    instrument.reset()
+    counts = Counter()
+    children = list(streamAugmentations(parents, counts))
+    return children, counts, instrument.snapshot() if instrument.ENABLED else None
+
+# Extends each parent in a chunk and keeps the first child of each canonical
+# form. Runs in a worker process, so the canonical forms are computed in
+# parallel and travel back with the children
+def extendChunk(parents):
+    instrument.reset()
+    counts = Counter()
+    children = {}
+    for child in streamExtensions(parents, counts):
+        with instrument.stage("filter"):
+            children.setdefault(child.canonicalForm(), child)
+    recorded = instrument.snapshot() if instrument.ENABLED else None
+    return list(children.values()), counts, recorded
+
+# Spreads the parents over a pool of worker processes in chunks, and merges
+# the children by canonical form in the order of the parents, so the
+# representatives are the same as those of the serial pipeline. With augment
+# the chunks are augmented instead, and their children are only concatenated.
+# What the workers record while instrumented is merged into this process
+def nextGenerationParallel(previousgen, counts, workers, chunksize=None, augment=False):
+    from concurrent.futures import ProcessPoolExecutor
+
+    if chunksize is None:
+        chunksize = max(1, len(previousgen) // (4 * workers))
+    chunks = [previousgen[i:i + chunksize]
+              for i in range(0, len(previousgen), chunksize)]
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=instrument.configure,
+                               initargs=(instrument.ENABLED,))
+
+    if augment:
+        nextgen = []
+        with pool as executor:
+            for children, chunkCounts, recorded in executor.map(augmentChunk, chunks):
+                counts.update(chunkCounts)
+                if recorded is not None:
+                    instrument.merge(recorded)
+                nextgen.extend(children)
+        return nextgen
+
+    representatives = {}
+    with pool as executor:
+        for children, chunkCounts, recorded in executor.map(extendChunk, chunks):
+            counts.update(chunkCounts)
+            if recorded is not None:
+                instrument.merge(recorded)
+            for child in children:
+                representatives.setdefault(child.canonicalForm(), child)
+    return list(representatives.values())
+
+# Checks a (count, 2^n) value matrix of unitary connectivities in bulk and
+# returns the mask of the rows having every property they should have
+def certifyGeneration(matrix):
+    return (batchNormal(matrix) & batchSubmodular(matrix) & batchSymmetric(matrix)
+            & batchUnitary(matrix) & batchConnected(matrix))
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Enumerates unitary connectivity functions")
+    parser.add_argument("--generations", type=int, default=5,
+                        help="number of elements to add to TWO")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes for each generation")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="parents sent to a worker at a time")
+    parser.add_argument("--store", default=None,
+                        help="directory to save each generation in and resume from")
+    parser.add_argument("--augment", action="store_true",
+                        help="keep canonical augmentations instead of filtering isomorphic extensions")
+    parser.add_argument("--engine", choices=["permutation", "polymatroid"],
+                        default="permutation",
+                        help="how a single process filters isomorphic extensions")
+    parser.add_argument("--output", default=None,
+                        help="directory to write each generation of functions to")
+    parser.add_argument("--format", choices=sorted(writer.WRITERS), default="binary",
+                        help="format of the files written to --output")
+    parser.add_argument("--print", action="store_true",
+                        help="print every function found, not only the summary")
+    parser.add_argument("--telemetry", default=None,
+                        help="file to append a JSON line of timings, memory and counters to per generation")
+    parser.add_argument("--certify", action="store_true",
+                        help="check every generated function is a unitary connectivity")
+    args = parser.parse_args()
+    if args.engine == "polymatroid" and (args.workers > 1 or args.augment):
+        parser.error("--engine polymatroid filters in a single process, "
+                     "so it can't be used with --workers or --augment")
+
     previousgen = [TWO]
     size = len(previousgen[0].groundset)
+    last = size + args.generations
     nextgen = []
-    
-    for i in range(5):
-        print("Unitary functions with |E| = " + str(size + 1 + i) + ".")
-
-        print("Finding all cuts. ", end="")
-        cuts = []
-        number = 0
-        for i in range(len(previousgen)):
-            cuts.append(set(listCuts(previousgen[i])))
-            number += len(cuts[i])
-        print("Found " + str(number))
-
-        number = 0
-        for i in range(len(cuts)):
-            cuts[i] = unitaryCuts(connectedCuts(cuts[i]))
-            number += len(cuts[i])
-
-        print("Of the cuts found, " + str(number) + " are elision, unitary, connected")
+
+    if args.store is not None:
+        os.makedirs(args.store, exist_ok=True)
+        latest = store.latestGeneration(args.store)
+        if latest is not None and latest[0] > size:
+            size, path = latest
+            previousgen = store.readGeneration(path)
+            print("Resuming from " + str(len(previousgen)) + " functions with |E| = " + str(size) + ".")
+
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+
+    if args.telemetry is not None:
+        instrument.configure(True)
+        telemetry = open(args.telemetry, "a")
+
+    for n in range(size + 1, last + 1):
+        print("Unitary functions with |E| = " + str(n) + ".")
+
+        instrument.reset()
+        start = time.perf_counter()
+        counts = Counter()
+        if args.workers > 1:
+            nextgen = nextGenerationParallel(previousgen, counts, args.workers,
+                                             args.chunksize, args.augment)
+        elif args.augment:
+            nextgen = list(streamAugmentations(previousgen, counts))
+        elif args.engine == "polymatroid":
+            nextgen = list(streamIsomorphicByPolymatroids(
+                streamExtensions(previousgen, counts)))
+        else:
+            nextgen = list(streamIsomorphicConnectivities(
+                streamExtensions(previousgen, counts)))
+
+        if args.augment:
+            print("Finding elision, unitary, connected cuts. Found " + str(counts["cuts"]))
+        else:
+            print("Finding unitary, connected cuts. Found " + str(counts["cuts"]))
+        print("Of the cuts found, " + str(counts["kept"]) + " are not related by automorphisms")
         
 #        print("Removing isomorphic pairs of cuts. ", end="")
 #        isopairs = len(cuts)
@@ -48,18 +227,11 @@ if __name__ == "__main__":
 #        print("Removed " + str(isopairs - nonisopairs) + \
 #              " in time " + str(timestop - timestart) + ".")
         
-        print("Finding all extensions. ", end="")
-        for i in range(len(previousgen)):
-            for j in range(len(cuts[i])):
-                nextgen.append(modularCutExtension(cuts[i][j], previousgen[i]))
-        print("Found " + str(len(nextgen)))
-        
-        print("Finding non-isomorphic extensions. ", end="")
-        nextgen = filterIsomorphicConnectivities(nextgen)
-        print("Found " + str(len(nextgen)))
-
-        for system in nextgen:
-            print(str(system))
+        print("Finding all extensions. Found " + str(counts["kept"]))
+        if args.augment:
+            print("Finding canonical augmentations. Found " + str(len(nextgen)))
+        else:
+            print("Finding non-isomorphic extensions. Found " + str(len(nextgen)))
         
 #        polys = [Polymatroid.from_conn(system) for system in nextgen]
 #        nextpolys = filterIsomorphicPolymatroids(polys)
@@ -74,6 +246,38 @@ if __name__ == "__main__":
 #        print("Removed " + str(origlen - newlen) + " in time " + \
 #              str(timestop - timestart))
 
+        if args.store is not None:
+            store.writeGeneration(store.generationPath(args.store, n), nextgen, n)
+
+        if args.telemetry is not None:
+            record = {"n": n, "seconds": round(time.perf_counter() - start, 6),
+                      "cuts": counts["cuts"], "kept": counts["kept"], "classes": len(nextgen),
+                      "worker_peak_rss_kb": instrument.workerPeak}
+            record.update(instrument.snapshot())
+            telemetry.write(json.dumps(record) + "\n")
+            telemetry.flush()
+
+        if args.certify:
+            import numpy as np
+            matrix = np.array([system.values for system in nextgen],
+                              dtype=np.int32).reshape(-1, 1 << n)
+            certified = int(certifyGeneration(matrix).sum())
+            print("Certifying extensions. " + str(certified) + " of " + str(len(nextgen))
+                  + " are normal, submodular, symmetric, unitary and connected")
+
+        if args.output is not None:
+            path = writer.outputPath(args.output, n, args.format)
+            if args.format == "binary":
+                out = writer.BinaryWriter(path, n, store.valueWidth(nextgen))
+            else:
+                out = writer.WRITERS[args.format](path, n)
+            with out:
+                out.writeAll(nextgen)
+        if args.print:
+            sys.stdout.flush()
+            with writer.TextWriter(None, n) as out:
+                out.writeAll(nextgen)
+
 # print("Printing " + str(len(nextgen)) + \
         #       " Connectivity Functions:")
         # for system in nextgen:
@@ -81,3 +285,6 @@ if __name__ == "__main__":
 
         previousgen = nextgen
         nextgen = []
+
+    if args.telemetry is not None:
+        telemetry.close()
@@ -1,145 +1,299 @@
 # Class definition for Modular Cut
 
-from itertools import combinations, product
-from helper import powerset
-import networkx as nx
+from helper import powerset, members, complementFamily
+from array import array
 
+import functions
+import instrument
 from functions import *
 
-# Class for Modular Cut, holds onto info re enumeration
+# Class for Modular Cut, holds onto info re enumeration. The cut is held as
+# an integer family, with bit m set for each member bitmask m, so hashing,
+# equality and the predicates are integer operations. The ground set and
+# subsets are those of the connectivity, which is shared rather than copied
 class ModularCut:
+    __slots__ = ('basis', 'connectivity', 'family', '_graph')
+
     def __init__(self, basis, connectivity):
         self.basis = frozenset(basis)
-        self.groundset = frozenset(connectivity.groundset)
-        self.subsets = frozenset(connectivity.subsets)
         self.connectivity = connectivity
-        self.cut = self.populateCut()
-        self.graph = self.cutGraph()
+        self.family = self.populateCut()
+        self._graph = self.cutGraph() if functions.EAGER_GRAPHS else None
 
     def __str__(self):
         return str(self.cut)
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return self.subsets == other.subsets
+            return self.family == other.family and \
+                (self.connectivity is other.connectivity or self.connectivity == other.connectivity)
         return False
 
     def __hash__(self):
-        return hash(self.cut)
+        return hash(self.family)
+
+    @classmethod
+    def from_cut(cls, cut, connectivity):
+        """Constructor from a family (cut) that is already a modular cut"""
+        family = 0
+        for s in cut:
+            family |= 1 << connectivity.mask(s)
+        return cls.from_family(family, connectivity)
+
+    @classmethod
+    def from_family(cls, family, connectivity):
+        """Constructor from an integer family that is already a modular cut"""
+        modcut = cls.__new__(cls)
+        modcut.basis = None
+        modcut.connectivity = connectivity
+        modcut.family = family
+        modcut._graph = modcut.cutGraph() if functions.EAGER_GRAPHS else None
+        return modcut
+
+    @property
+    def groundset(self):
+        """The ground set of the connectivity"""
+        return self.connectivity.groundset
+
+    @property
+    def subsets(self):
+        """The subsets of the ground set of the connectivity"""
+        return self.connectivity.subsets
+
+    @property
+    def cut(self):
+        """The members of the cut as a frozenset of frozensets"""
+        sets = self.connectivity.table.sets
+        return frozenset(sets[m] for m in members(self.family))
+
+    @property
+    def graph(self):
+        """The graph of the cut structure, built on first access"""
+        if self._graph is None:
+            self._graph = self.cutGraph()
+        return self._graph
     
     def populateCut(self):
-        def iterate(basis):
-            cut = basis
-            for b in basis:
-                if type(b) is int:
-                    b = frozenset([b])
-                    
-                for e in self.groundset:
-                    cut = cut.union(set([(b.union(set([e])))]))
-                    
-                pairs = product(cut, repeat=2)
-
-                for p0, p1 in pairs:
-                    if self.connectivity.modular(p0, p1):
-                        cut = cut.union(set([(p0.intersection(p1))]))
-            return cut
-
-        cut0 = self.basis
-        cut1 = iterate(cut0)
-        while (cut0 != cut1):
-            cut0 = iterate(cut1)
-            cut1 = iterate(cut0)
-        return cut0
+        """Closes the basis under supersets and modular intersections"""
+        family = 0
+        for b in self.basis:
+            if type(b) is int:
+                b = frozenset([b])
+            family |= 1 << self.connectivity.mask(b)
+        return closeFamily(family, self.connectivity)
 
     def isElision(self):
-        for sub in self.subsets:
-            if (not (sub in self.cut)) and (not ((self.groundset - sub) in self.cut)):
-                return False
-        return True
+        """True if every subset or its complement is in the cut"""
+        size = len(self.connectivity.values)
+        return self.family | complementFamily(self.family, size) == (1 << size) - 1
 
     def isUnitary(self):
-        for e in self.groundset:
-            if not ((self.groundset - frozenset([e])) in self.cut):
+        """True if every hyperplane, a ground set less one element, is in
+           the cut"""
+        full = len(self.connectivity.values) - 1
+        for b in self.connectivity.table.bits:
+            if not (self.family >> (full ^ b) & 1):
                 return False
-
         return True
 
     def isConnected(self):
-        return not (frozenset() in self.cut)
+        """True if the empty set is not in the cut"""
+        return not (self.family & 1)
     
     def cutGraph(self):
+        import networkx as nx
+
 #        G = self.connectivity.inclusionGraph.copy()
         G = nx.DiGraph()
         # Encode the cut structure
+        cut = self.cut
         for s in self.subsets:
             c = (self.groundset - s)
-            if s in self.cut and c in self.cut:
+            if s in cut and c in cut:
                 G.add_edge(s, "x")
                 G.add_edge("x", s)
-            if s in self.cut and (not (c in self.cut)):
+            if s in cut and (not (c in cut)):
                 G.add_edge(s, "x")
-            if (not (s in self.cut)) and (c in self.cut):
+            if (not (s in cut)) and (c in cut):
                 G.add_edge("x", s)
-            if (not (s in self.cut)) and (not (c in self.cut)):
+            if (not (s in cut)) and (not (c in cut)):
                 G.add_node(s)
                 G.add_node(c)
         
         return G
     
+# Closes a family of subsets, given as an integer with bit m set for each
+# member bitmask m, under supersets and intersections of modular pairs.
+# Sets are taken off a worklist as they are added, so each pair of members
+# is examined once, when the later of the two is taken. Closing only adds
+# sets, so None is returned as soon as a member of forbidden enters
+def closeFamily(family, connectivity, forbidden=0):
+    if family & forbidden:
+        if instrument.ENABLED:
+            countClosure(0, 0)
+        return None
+    above = connectivity.table.above
+    cut = family
+    work = family
+    while work:
+        low = work & -work
+        work ^= low
+        m = low.bit_length() - 1
+        added = above[m]
+        for k in members(connectivity.modularPartners(m) & cut):
+            added |= 1 << (m & k)
+        added &= ~cut
+        if added & forbidden:
+            if instrument.ENABLED:
+                countClosure(cut, work)
+            return None
+        cut |= added
+        work |= added
+    if instrument.ENABLED:
+        countClosure(cut, 0)
+    return cut
+
+# Counts a closure whose worklist has given up the sets of cut not in work.
+# Each set enters the worklist once, so they are the passes made
+def countClosure(cut, work):
+    instrument.count("closures")
+    instrument.count("passes", bin(cut & ~work).count("1"))
+
 # Takes a Connectivity and a ModularCut, adds a new element to the ground
 # set and extends the mapping
 def modularCutExtension(modcut, connectivity):
-    oldmapping = connectivity.mapping
-    newelement = len(connectivity.groundset)
-    newground = set(range(newelement + 1))
-    
-    subsets = [frozenset(s) for s in powerset(connectivity.groundset)]
-    newmapping = {}
-    for s in subsets:
-        if s in modcut.cut:
-            newmapping[frozenset(s | set([newelement]))] = \
-                oldmapping[frozenset(s)]
+    if modcut.connectivity is connectivity:
+        return familyExtension(connectivity, modcut.family)
+    cut = 0
+    for s in modcut.cut:
+        cut |= 1 << connectivity.mask(s)
+    return familyExtension(connectivity, cut)
+
+# Extends a Connectivity by a modular cut given as an integer family
+def familyExtension(connectivity, cut):
+    oldvalues = connectivity.values
+    newground = range(len(connectivity.groundset) + 1)
+
+    # The new element takes the next bit, so s | size is s with it added
+    size = len(oldvalues)
+    full = size - 1
+    newvalues = array('i', [0]) * (2 * size)
+    for s in range(size):
+        if cut >> s & 1:
+            newvalues[s | size] = oldvalues[s]
         else:
-            newmapping[frozenset(s | set([newelement]))] = \
-                oldmapping[frozenset(s)] + 1
-            
-        if (connectivity.groundset - s) in modcut.cut:
-            newmapping[frozenset(s)] = oldmapping[s] 
+            newvalues[s | size] = oldvalues[s] + 1
+
+        if cut >> (full ^ s) & 1:
+            newvalues[s] = oldvalues[s]
         else:
-            newmapping[frozenset(s)] = oldmapping[s] + 1
+            newvalues[s] = oldvalues[s] + 1
+
+    return Connectivity.from_values(newvalues, newground)
+
+def batchExtension(values, cuts):
+    """Extends one value vector by a stack of modular cuts, given as integer
+       families, at once. Returns a (len(cuts), 2 * len(values)) NumPy array
+       whose k-th row is the extension by the k-th cut"""
+    import numpy as np
+    v = np.asarray(values, dtype=np.int32)
+    size = len(v)
+    width = (size + 7) // 8
+    packed = np.frombuffer(b"".join(cut.to_bytes(width, 'little') for cut in cuts),
+                           dtype=np.uint8).reshape(len(cuts), width)
+    inCut = np.unpackbits(packed, axis=1, count=size, bitorder='little').astype(bool)
+
+    children = np.empty((len(cuts), 2 * size), dtype=np.int32)
+    # s | size contains the new element, and grows unless s is in the cut
+    children[:, size:] = v + ~inCut
+    # s grows unless its complement full ^ s = full - s is in the cut
+    children[:, :size] = v + ~inCut[:, ::-1]
+    return children
 
-    return Connectivity(newmapping, newground)
+# Relabels an integer family by the image of every bitmask under a
+# permutation of the ground set
+def relabelFamily(family, image):
+    relabeled = 0
+    for m in members(family):
+        relabeled |= 1 << image[m]
+    return relabeled
+
+# Yields one cut from each orbit of cuts under the automorphism group of
+# the Connectivity, as cuts related by an automorphism give isomorphic
+# extensions. The cuts must be closed under the group, as the cuts of
+# cutFamilies are. Orbits are filled in from a generating set of the group,
+# so each cut is relabeled once per generator
+def orbitRepresentatives(connectivity, cuts):
+    generators = connectivity.automorphismGenerators()
+    if not generators:
+        yield from cuts
+        return
+    seen = set()
+    for cut in cuts:
+        if cut in seen:
+            continue
+        yield cut
+        seen.add(cut)
+        orbit = [cut]
+        while orbit:
+            family = orbit.pop()
+            for image in generators:
+                relabeled = relabelFamily(family, image)
+                if relabeled not in seen:
+                    seen.add(relabeled)
+                    orbit.append(relabeled)
+
+# Yields the extensions of a Connectivity by each cut in a list of integer
+# families. They are computed in batches of BATCH_ROWS cuts when NumPy is
+# available, so only one block of children is held at a time
+def cutExtensions(connectivity, cuts):
+    newground = range(len(connectivity.groundset) + 1)
+    for start in range(0, len(cuts), functions.BATCH_ROWS):
+        block = cuts[start:start + functions.BATCH_ROWS]
+        try:
+            children = batchExtension(connectivity.values, block)
+        except ImportError:
+            for cut in block:
+                yield familyExtension(connectivity, cut)
+            continue
+        for row in children:
+            yield Connectivity.from_values(array('i', row.tobytes()), newground)
 
 # Some functions for producing modular cuts
 # The cut with the most elements
 def maximalCut(connectivity):
-    return modularCut(frozenset([frozenset()]), connectivity)
+    return ModularCut(frozenset([frozenset()]), connectivity)
 
 # The cut with the fewest elements
 def minimalCut(connectivity):
-    return modularCut(frozenset([connectivity.groundset]), connectivity)
+    return ModularCut(frozenset([connectivity.groundset]), connectivity)
+
+# Builds the ModularCut generated by an integer family of subsets
+def familyCut(family, connectivity):
+    return ModularCut.from_family(closeFamily(family, connectivity), connectivity)
 
 # Finds the modular cut corresponding to the flats of the polymatroid
 def flatsCut(connectivity):
-    polymatroid = connectivityPolymatroid(connectivity)
-    return modularCut(polymatroid.flats, connectivity)
+    polymatroid = Polymatroid.from_conn(connectivity)
+    return familyCut(polymatroid.flatFamily, connectivity)
 
 def flatsAndComplementsCut(connectivity):
-    polymatroid = connectivityPolymatroid(connectivity)
-    antiflats = frozenset(
-        [polymatroid.groundset - f for f in polymatroid.flats])
-    return modularCut(polymatroid.flats | antiflats, connectivity)
+    polymatroid = Polymatroid.from_conn(connectivity)
+    size = len(connectivity.values)
+    flats = polymatroid.flatFamily
+    return familyCut(flats | complementFamily(flats, size), connectivity)
 
 # Finds the modular cut corresponding to the nonflats of the polymatroid
 def nonFlatsCut(connectivity):
-    polymatroid = connectivityPolymatroid(connectivity)
-    return modularCut(polymatroid.nonflats, connectivity)
+    polymatroid = Polymatroid.from_conn(connectivity)
+    size = len(connectivity.values)
+    return familyCut(((1 << size) - 1) ^ polymatroid.flatFamily, connectivity)
 
 def nonFlatsAndComplementsCut(connectivity):
-    polymatroid = connectivityPolymatroid(connectivity)
-    antinonflats = frozenset(
-        [polymatroid.groundset - n for n in polymatroid.nonflats])
-    return modularCut(polymatroid.nonflats | antinonflats, connectivity)
+    polymatroid = Polymatroid.from_conn(connectivity)
+    size = len(connectivity.values)
+    nonflats = ((1 << size) - 1) ^ polymatroid.flatFamily
+    return familyCut(nonflats | complementFamily(nonflats, size), connectivity)
 
 def listCuts(connectivity):
     """Returns a list of all modular cuts that are nonempty"""
@@ -147,6 +301,65 @@ def listCuts(connectivity):
     cuts = [ModularCut(family, connectivity) for family in families]
     return cuts
 
+def enumerateCuts(connectivity, connected=False, unitary=False, elision=False):
+    """Yields the modular cuts of cutFamilies as ModularCut objects"""
+    for cut in cutFamilies(connectivity, connected, unitary, elision):
+        yield ModularCut.from_family(cut, connectivity)
+
+def cutFamilies(connectivity, connected=False, unitary=False, elision=False):
+    """Yields every distinct modular cut exactly once, including the empty cut,
+    as an integer with bit m set for each member bitmask m.
+
+    Modular cuts are the closed families of a closure system on the subsets,
+    so they are walked in lectic order with Ganter's NextClosure: each cut is
+    reached from its lectic predecessor, so no family is closed twice and
+    no set of seen cuts is kept.
+
+    Only cuts with the properties asked for are yielded, and the walk is
+    pruned with them: a connected cut never contains the empty set, so a
+    closure stops once it enters, a unitary cut contains every hyperplane,
+    so the walk starts from the closure of the hyperplanes, and an elision
+    cut contains a set or its complement, so no branch leaving out both is
+    entered."""
+    size = len(connectivity.values)
+    full = size - 1
+    connectivity.modularIndex()
+
+    forbidden = 1 if connected else 0
+    required = 0
+    if unitary:
+        for b in connectivity.table.bits:
+            required |= 1 << (full ^ b)
+
+    def closure(family):
+        return closeFamily(family | required, connectivity, forbidden)
+
+    cut = closure(0)
+    if cut is None:
+        return
+    while True:
+        if not elision or cut | complementFamily(cut, size) == (1 << size) - 1:
+            yield cut
+        prefix = cut
+        for m in reversed(range(size)):
+            bit = 1 << m
+            if prefix & bit:
+                prefix ^= bit
+                continue
+            if elision:
+                # Bitmasks below m outside prefix stay outside the branch
+                absent = ~prefix & (bit - 1)
+                if absent & complementFamily(absent, size):
+                    continue
+            # Every cut agreeing with prefix below m and containing m
+            # contains nextCut, so a forbidden set rules them all out
+            nextCut = closure(prefix | bit)
+            if nextCut is not None and not (nextCut & ~prefix & (bit - 1)):
+                cut = nextCut
+                break
+        else:
+            return
+
 def elisionCuts(cutList):
     return [cut for cut in cutList if cut.isElision()]
 
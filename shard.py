@@ -0,0 +1,126 @@
+from functions import Connectivity
+from main import extendChunk, augmentChunk
+from array import array
+from collections import Counter
+import argparse
+import json
+import os
+import socket
+import store
+
+# Splits the step to the generation with |E| = n over worker invocations
+# that share nothing but a directory, so it runs on any batch cluster. The
+# parents are the generation with |E| = n - 1 stored in the directory, dealt
+# round robin into shards. A worker claims a shard by creating its claim
+# file exclusively, extends the parents of the shard and writes the children
+# to the shard file, in canonical form unless they are canonical
+# augmentations. Once every shard file is written, merge deduplicates the
+# children by their values into the generation with |E| = n, which main.py
+# --store resumes from
+
+def shardPath(directory, n, shard, shards, extension=".bin"):
+    return os.path.join(directory, "generation" + str(n) + ".shard" + str(shard)
+                        + "-of-" + str(shards) + extension)
+
+def shardParents(previousgen, shard, shards):
+    """The parents dealt to a shard"""
+    return previousgen[shard::shards]
+
+def claimShard(directory, n, shard, shards):
+    """Claims a shard for this process. Returns False if it was claimed
+       already, as creating the claim file only succeeds once"""
+    try:
+        claim = os.open(shardPath(directory, n, shard, shards, ".claim"),
+                        os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(claim, "w") as out:
+        out.write(socket.gethostname() + ":" + str(os.getpid()) + "\n")
+    return True
+
+def isShardDone(directory, n, shard, shards):
+    return os.path.exists(shardPath(directory, n, shard, shards))
+
+def runShard(directory, n, shard, shards, augment=False):
+    """Extends the parents of a shard and writes the children and counts of
+       the shard. Returns the counts"""
+    previousgen = store.readGeneration(store.generationPath(directory, n - 1))
+    parents = shardParents(previousgen, shard, shards)
+    if augment:
+        children, counts, recorded = augmentChunk(parents)
+    else:
+        # Children in canonical form are equal exactly when isomorphic, so
+        # the merge needs no canonical forms of its own
+        representatives, counts, recorded = extendChunk(parents)
+        children = [Connectivity.from_values(array('i', child.canonicalForm()), range(n))
+                    for child in representatives]
+
+    # The counts are written first, so a shard file always has them
+    temporary = shardPath(directory, n, shard, shards, ".json.part")
+    with open(temporary, "w") as out:
+        json.dump(counts, out)
+    os.replace(temporary, shardPath(directory, n, shard, shards, ".json"))
+    store.writeGeneration(shardPath(directory, n, shard, shards), children, n)
+    return counts
+
+def work(directory, n, shards, augment=False):
+    """Runs every shard not yet claimed, until none are left. Returns the
+       shards run"""
+    done = []
+    for shard in range(shards):
+        if isShardDone(directory, n, shard, shards):
+            continue
+        if claimShard(directory, n, shard, shards):
+            runShard(directory, n, shard, shards, augment)
+            done.append(shard)
+    return done
+
+def mergeShards(directory, n, shards):
+    """Deduplicates the children of every shard by their values, writes them
+       as the generation with |E| = n and returns them with the summed counts"""
+    missing = [shard for shard in range(shards) if not isShardDone(directory, n, shard, shards)]
+    if missing:
+        raise Exception("Shards " + ", ".join(map(str, missing)) + " of generation "
+                        + str(n) + " are not done")
+    representatives = {}
+    counts = Counter()
+    for shard in range(shards):
+        with open(shardPath(directory, n, shard, shards, ".json")) as source:
+            counts.update(json.load(source))
+        for child in store.readGeneration(shardPath(directory, n, shard, shards)):
+            representatives.setdefault(tuple(child.values), child)
+    nextgen = list(representatives.values())
+    store.writeGeneration(store.generationPath(directory, n), nextgen, n)
+    return nextgen, counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs a generation step as shards sharing a directory")
+    parser.add_argument("command", choices=["work", "merge"],
+                        help="work on shards, or merge the finished shards")
+    parser.add_argument("directory",
+                        help="shared directory holding the generation with |E| = n - 1")
+    parser.add_argument("n", type=int,
+                        help="|E| of the generation to find")
+    parser.add_argument("--shards", type=int, required=True,
+                        help="number of shards the parents are dealt into")
+    parser.add_argument("--shard", type=int, default=None,
+                        help="run only this shard, whether claimed or not, as when retrying it")
+    parser.add_argument("--augment", action="store_true",
+                        help="keep canonical augmentations instead of canonical forms")
+    args = parser.parse_args()
+
+    if args.command == "work":
+        if args.shard is not None:
+            runShard(args.directory, args.n, args.shard, args.shards, args.augment)
+            done = [args.shard]
+        else:
+            done = work(args.directory, args.n, args.shards, args.augment)
+        print("Ran shards " + ", ".join(map(str, done)) + " of " + str(args.shards) + ".")
+    else:
+        nextgen, counts = mergeShards(args.directory, args.n, args.shards)
+        print("Unitary functions with |E| = " + str(args.n) + ".")
+        print("Finding unitary, connected cuts. Found " + str(counts["cuts"]))
+        print("Of the cuts found, " + str(counts["kept"]) + " are not related by automorphisms")
+        print("Merging shards. Found " + str(len(nextgen)))
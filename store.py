@@ -0,0 +1,124 @@
+from functions import Connectivity
+from array import array
+import os
+import re
+import struct
+import sys
+
+# A generation file holds the value vectors of functions on the ground set
+# {0,...,n-1}, each indexed by bitmask, one after another behind a fixed
+# header of magic, n, bytes per value and count. The values are little
+# endian and start at HEADER_SIZE, so the file can be memory-mapped as a
+# (count, 2^n) matrix without parsing
+MAGIC = b"UCON"
+HEADER = struct.Struct("<4sIIQ")
+HEADER_SIZE = 32
+TYPECODES = {1: 'b', 4: 'i'}
+DTYPES = {1: "<i1", 4: "<i4"}
+FILENAME = re.compile(r"generation(\d+)\.bin$")
+
+def generationPath(directory, n):
+    return os.path.join(directory, "generation" + str(n) + ".bin")
+
+def valueWidth(functions):
+    """Bytes per value needed to store every value of functions"""
+    if all(-128 <= value < 128 for function in functions for value in function.values):
+        return 1
+    return 4
+
+def writeGeneration(path, functions, n):
+    """Writes the value vectors of functions on n elements to path.
+       The file is written under a temporary name and renamed when complete,
+       so a crash never leaves a partial generation behind"""
+    width = valueWidth(functions)
+    temporary = path + ".part"
+    with open(temporary, "wb") as out:
+        out.write(HEADER.pack(MAGIC, n, width, len(functions)).ljust(HEADER_SIZE, b"\0"))
+        for function in functions:
+            values = array(TYPECODES[width], function.values)
+            if sys.byteorder == "big":
+                values.byteswap()
+            values.tofile(out)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(temporary, path)
+
+def readHeader(path):
+    """Returns n, bytes per value and count of a generation file"""
+    with open(path, "rb") as source:
+        header = source.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise Exception(path + " is not a generation file")
+    magic, n, width, count = HEADER.unpack_from(header)
+    if magic != MAGIC or width not in TYPECODES:
+        raise Exception(path + " is not a generation file")
+    if os.path.getsize(path) != HEADER_SIZE + (count * width << n):
+        raise Exception(path + " is truncated")
+    return n, width, count
+
+def readGeneration(path):
+    """Reads a generation file back into a list of Connectivity functions"""
+    n, width, count = readHeader(path)
+    size = 1 << n
+    values = array(TYPECODES[width])
+    with open(path, "rb") as source:
+        source.seek(HEADER_SIZE)
+        values.fromfile(source, count * size)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return [Connectivity.from_values(array('i', values[i * size:(i + 1) * size]), range(n))
+            for i in range(count)]
+
+def latestGeneration(directory):
+    """Returns n and the path of the largest complete generation stored in
+       directory, or None when there is none"""
+    if not os.path.isdir(directory):
+        return None
+    stored = []
+    for name in os.listdir(directory):
+        match = FILENAME.match(name)
+        if match:
+            stored.append(int(match.group(1)))
+    for n in sorted(stored, reverse=True):
+        path = generationPath(directory, n)
+        try:
+            readHeader(path)
+        except Exception:
+            continue
+        return n, path
+    return None
+
+def mapGeneration(path):
+    """Maps a generation file read-only as a (count, 2^n) NumPy matrix"""
+    import numpy as np
+    n, width, count = readHeader(path)
+    if count == 0:
+        # An empty mapping is not allowed, and there is nothing to map
+        return np.zeros((0, 1 << n), dtype=DTYPES[width])
+    return np.memmap(path, dtype=DTYPES[width], mode="r",
+                     offset=HEADER_SIZE, shape=(count, 1 << n))
+
+class GenerationView:
+    """The functions of a stored generation, read through a memory map.
+
+    Each function is a Connectivity built on demand over a row of the map,
+    so its values are read from the file as they are used and never copied
+    into Python objects. Only the functions in use are kept alive."""
+
+    def __init__(self, path):
+        self.matrix = mapGeneration(path)
+        self.elements = range(readHeader(path)[0])
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def __getitem__(self, i):
+        row = self.matrix[i]
+        if sys.byteorder == "big":
+            # Rows are little endian, so they are copied into native order
+            row = array('i', row.astype("=i4").tobytes())
+        return Connectivity.from_values(memoryview(row), self.elements)
+
+    def __iter__(self):
+        for i in range(len(self.matrix)):
+            yield self[i]
@@ -1,6 +1,22 @@
 from modularcut import *
 from functions import *
 from main import *
+import bench
+import functions as setfunctions
+import instrument
+import json
+import os
+import shard
+import store
+import subprocess
+import sys
+import tempfile
+import writer
+
+# Seconds a fresh interpreter should take to import main, about ten times
+# what it takes. Wall-clock time depends on the machine, so going over it
+# is reported rather than failed
+STARTUP_BUDGET = 0.25
 
 groundset = frozenset([0, 1, 2])
 bases = [frozenset([frozenset()]), frozenset([frozenset([0])]), frozenset([frozenset([0]), frozenset([1])]),
@@ -118,6 +134,11 @@ functions = [
                  frozenset({0, 1, 2, 3}))
 ]
 
+# The non-isomorphic extensions of THREE and of those, shared by the tests
+# that need whole generations
+generation4 = list(streamIsomorphicConnectivities(streamExtensions([THREE], Counter())))
+generation5 = list(streamIsomorphicConnectivities(streamExtensions(generation4, Counter())))
+
 
 def modularCutTest():
     # Tests that the correct cut is produced from a given basis
@@ -125,6 +146,7 @@ def modularCutTest():
     constructionTest1()
     constructionTest2()
     constructionTest3()
+    constructionTest4()
 
     # Tests that the correct function is produced in an extension
     extensionTest0()
@@ -136,14 +158,393 @@ def modularCutTest():
     isoTest1()
     isoTest2()
     isoTest3()
+    isoTest4()
+    canonicalTest0()
+    fingerprintTest0()
 
     # Tests the isomorphism filtering
     isoFilterTest0()
 
+    # Tests the bitmask representation of set functions
+    representationTest0()
+
+    # Tests that graphs are only built when used
+    graphTest0()
+
+    # Tests that importing the program stays cheap
+    startupTest0()
+
+    # Tests the modular pair index
+    modularIndexTest0()
+
+    # Tests the enumeration of modular cuts
+    enumerationTest0()
+    enumerationTest1()
+    enumerationTest2()
+    storeTest0()
+    storeTest1()
+    writerTest0()
+    writerTest1()
+    certifyTest0()
+    validTest0()
+    batchExtensionTest0()
+    orbitTest0()
+    augmentationTest0()
+    polymatroidTest0()
+    flatsTest0()
+    benchTest0()
+    instrumentTest0()
+
+    # Tests the parallel generation step
+    parallelTest0()
+    shardTest0()
+
 def isoFilterTest0():
     for fun in filterIsomorphicConnectivities(functions):
         print(str(fun))
 
+def representationTest0():
+    Copy = Connectivity.from_values(THREE.values, THREE.groundset)
+
+    assert Copy.mapping == THREE.mapping, str(Copy) + " should be " + str(THREE)
+    assert str(Copy) == "0:\t[] [0, 1, 2] \n1:\t[0] [1] [2] [0, 1] [0, 2] [1, 2] \n", \
+        str(Copy) + " has the wrong format"
+    assert Copy.function(set([0, 1])) == 1, "function should accept any set"
+
+def graphTest0():
+    Copy = Connectivity.from_values(THREE.values, THREE.groundset)
+    cut = ModularCut(bases[1], Copy)
+
+    assert Copy._graph is None and cut._graph is None, "Graphs should not be built eagerly"
+    assert Copy.graph is Copy.graph, "The graph should be built once"
+    assert set(cut.graph.nodes) >= {"x"}, "The cut graph should be built on access"
+
+def startupTest0():
+    script = "import sys, time\n" \
+        "start = time.perf_counter()\n" \
+        "import main\n" \
+        "print(time.perf_counter() - start)\n" \
+        "print(' '.join(m for m in ('networkx', 'matplotlib', 'numpy') if m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split("\n")
+
+    assert out[1] == "", "Importing main should not load " + out[1]
+    if float(out[0]) > STARTUP_BUDGET:
+        print("Importing main took " + out[0] + "s, over " + str(STARTUP_BUDGET) + "s", file=sys.stderr)
+
+def modularIndexTest0():
+    index = functions[1].modularIndex()
+    for p0 in functions[1].subsets:
+        for p1 in functions[1].subsets:
+            m0, m1 = functions[1].mask(p0), functions[1].mask(p1)
+            assert (index[m0] >> m1 & 1) == functions[1].modular(p0, p1), \
+                str(p0) + ", " + str(p1) + " is indexed wrongly"
+    assert functions[1].modularIndexBytes() > 0, "The index should report its size"
+
+def enumerationTest0():
+    Expected = set(cut.cut for cut in listCuts(THREE))
+    Found = [cut.cut for cut in enumerateCuts(THREE)]
+
+    assert len(Found) == len(set(Found)), "Cuts of THREE should be enumerated once"
+    assert set(Found) == Expected, str(Found) + " should be " + str(Expected)
+
+def enumerationTest1():
+    Expected = set(cut.cut for cut in listCuts(TWO))
+    Found = [cut.cut for cut in enumerateCuts(TWO)]
+
+    # TWO has the empty cut, the full cut and four cuts in between
+    assert len(Found) == 6, str(len(Found)) + " should be 6"
+    assert set(Found) == Expected, str(Found) + " should be " + str(Expected)
+
+def enumerationTest2():
+    for connectivity in [TWO, THREE] + functions:
+        for connected, unitary, elision in product([False, True], repeat=3):
+            Expected = set(cut.cut for cut in enumerateCuts(connectivity)
+                           if (not connected or cut.isConnected())
+                           and (not unitary or cut.isUnitary())
+                           and (not elision or cut.isElision()))
+            Found = [cut.cut for cut in enumerateCuts(connectivity, connected, unitary, elision)]
+
+            assert len(Found) == len(set(Found)), "Pruned cuts should be enumerated once"
+            assert set(Found) == Expected, "Pruning should keep exactly the cuts passing the predicates"
+
+def storeTest0():
+    Generation = generation4
+    with tempfile.TemporaryDirectory() as directory:
+        assert store.latestGeneration(directory) is None, "An empty directory has no generation"
+        store.writeGeneration(store.generationPath(directory, 4), Generation, 4)
+        store.writeGeneration(store.generationPath(directory, 3), [THREE], 3)
+        # A generation that was being written when the run died is ignored
+        with open(store.generationPath(directory, 5), "wb") as partial:
+            partial.write(b"UCON")
+
+        n, path = store.latestGeneration(directory)
+        assert n == 4, str(n) + " should be 4"
+        assert store.readHeader(path) == (4, 1, len(Generation)), "The header should hold n and count"
+        assert store.readGeneration(path) == Generation, "Stored functions should read back equal"
+        assert store.readGeneration(store.generationPath(directory, 3)) == [THREE], \
+            "THREE should read back equal"
+
+def storeTest1():
+    try:
+        import numpy
+    except ImportError:
+        return
+    Generation = generation4
+    with tempfile.TemporaryDirectory() as directory:
+        path = store.generationPath(directory, 4)
+        store.writeGeneration(path, Generation, 4)
+        View = store.GenerationView(path)
+
+        assert store.mapGeneration(path).shape == (len(Generation), 16), "The map should be count by 2^n"
+        assert len(View) == len(Generation), str(len(View)) + " should be " + str(len(Generation))
+        assert list(View) == Generation, "Mapped functions should equal the stored ones"
+        assert [f.canonicalForm() for f in View] == [f.canonicalForm() for f in Generation], \
+            "Mapped functions should have the same canonical forms"
+        assert len(filterIsomorphicConnectivities(View)) == len(Generation), \
+            "A stored generation has no isomorphic pairs"
+        del View
+
+def writerTest0():
+    Generation = generation4
+    size = writer.BUFFER_SIZE
+    writer.BUFFER_SIZE = 20
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for format in writer.WRITERS:
+                with writer.WRITERS[format](writer.outputPath(directory, 4, format), 4) as out:
+                    out.writeAll(Generation)
+            with open(writer.outputPath(directory, 4, "jsonl")) as source:
+                Lines = [json.loads(line)["values"] for line in source]
+            with open(writer.outputPath(directory, 4, "text")) as source:
+                Text = source.read()
+
+            assert store.readGeneration(writer.outputPath(directory, 4, "binary")) == Generation, \
+                "Written value vectors should read back equal"
+            assert Lines == [list(system.values) for system in Generation], "Each JSON line should hold a function"
+            assert Text == "".join(str(system) + "\n" for system in Generation), "Text should be as printed"
+    finally:
+        writer.BUFFER_SIZE = size
+
+def writerTest1():
+    Generation = generation4
+    Wide = Generation[:2] + [Connectivity.from_values(array('i', [200 * v for v in Generation[2].values]),
+                                                      range(4))] + Generation[3:]
+    with tempfile.TemporaryDirectory() as directory:
+        path = writer.outputPath(directory, 4, "binary")
+        with writer.BinaryWriter(path, 4) as out:
+            out.writeAll(Wide)
+
+        assert store.readHeader(path) == (4, 4, len(Wide)), "A value too wide should widen the file"
+        assert store.readGeneration(path) == Wide, "Widened value vectors should read back equal"
+
+        # A failed run leaves the earlier file and no temporary one
+        try:
+            with writer.BinaryWriter(path, 4) as out:
+                out.writeAll(Generation)
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+        assert store.readGeneration(path) == Wide, "An aborted writer should not replace the file"
+        assert os.listdir(directory) == [os.path.basename(path)], str(os.listdir(directory))
+
+def certifyTest0():
+    try:
+        import numpy as np
+    except ImportError:
+        return
+    Generation = generation4
+    # The pair {0, 1} and its complement are too big for submodularity
+    Values = array('i', Generation[0].values)
+    Values[3] = Values[12] = 3
+    Broken = Connectivity.from_values(Values, range(4))
+    Matrix = np.array([f.values for f in Generation + [Broken]], dtype=np.int32)
+
+    assert list(certifyGeneration(Matrix)) == [True] * len(Generation) + [False], \
+        "Only the broken function should fail certification"
+    for check, method in [(batchSubmodular, "isSubmodular"), (batchSymmetric, "isSymmetric"),
+                          (batchUnitary, "isUnitary"), (batchConnected, "isConnected")]:
+        assert list(check(Matrix)) == [getattr(f, method)() for f in Generation + [Broken]], \
+            check.__name__ + " should agree with " + method
+
+def validTest0():
+    assert THREE.isSubmodular(), str(THREE) + " should be submodular"
+    assert THREE.isValid(), str(THREE) + " should be valid"
+    Broken = Connectivity.from_values(array('i', [0, 1, 1, 3, 1, 1, 1, 0]), range(3))
+    assert not Broken.isSubmodular(), str(Broken) + " should not be submodular"
+    assert not Broken.isValid(), str(Broken) + " should not be valid"
+
+def batchExtensionTest0():
+    for connectivity in [TWO, THREE] + functions:
+        cuts = list(cutFamilies(connectivity))
+        Expected = [modularCutExtension(cut, connectivity) for cut in enumerateCuts(connectivity)]
+
+        assert [familyExtension(connectivity, cut) for cut in cuts] == Expected, \
+            "Extending by integer families should match modularCutExtension"
+        assert list(cutExtensions(connectivity, cuts)) == Expected, \
+            "The batched extension should match modularCutExtension"
+    assert list(cutExtensions(THREE, [])) == [], "No cuts give no extensions"
+
+    rows = setfunctions.BATCH_ROWS
+    setfunctions.BATCH_ROWS = 3
+    try:
+        cuts = list(cutFamilies(THREE))
+        assert list(cutExtensions(THREE, cuts)) == [familyExtension(THREE, cut) for cut in cuts], \
+            "Extending in blocks should match extending cut by cut"
+    finally:
+        setfunctions.BATCH_ROWS = rows
+
+def orbitTest0():
+    # Closing the generators of THREE gives all six permutations
+    Generators = THREE.automorphismGenerators()
+    Group = {tuple(range(8))}
+    Frontier = list(Group)
+    while Frontier:
+        g = Frontier.pop()
+        for image in Generators:
+            gh = tuple(image[m] for m in g)
+            if gh not in Group:
+                Group.add(gh)
+                Frontier.append(gh)
+    assert len(Group) == 6, str(len(Group)) + " should be 6"
+    assert TWO.automorphismGenerators() != [], "TWO has the swap of its elements"
+
+    # Every relabeling is an automorphism of min(|A|, n - |A|), and the
+    # generators are found without listing the group
+    Symmetric = Connectivity.from_values(array('i', [min(bin(m).count("1"), 5 - bin(m).count("1"))
+                                                     for m in range(32)]), range(5))
+    Generators = Symmetric.automorphismGenerators()
+    Group = {tuple(range(32))}
+    Frontier = list(Group)
+    while Frontier:
+        g = Frontier.pop()
+        for image in Generators:
+            gh = tuple(image[m] for m in g)
+            if gh not in Group:
+                Group.add(gh)
+                Frontier.append(gh)
+    assert len(Group) == 120, str(len(Group)) + " should be 120"
+    assert len(Generators) <= 4, str(len(Generators)) + " generators should be at most 4"
+
+    for connectivity in [TWO, THREE] + functions:
+        cuts = list(cutFamilies(connectivity, connected=True, unitary=True))
+        Representatives = list(orbitRepresentatives(connectivity, cuts))
+        Expected = set(child.canonicalForm() for child in cutExtensions(connectivity, cuts))
+        Found = [child.canonicalForm() for child in cutExtensions(connectivity, Representatives)]
+
+        assert set(Found) == Expected, "Orbit representatives should give every extension"
+        assert len(Representatives) <= len(cuts), "There should be no more orbits than cuts"
+
+def augmentationTest0():
+    Filtered = [TWO]
+    Augmented = [TWO]
+    for n in range(3, 7):
+        Filtered = filterIsomorphicConnectivities(streamExtensions(Filtered, Counter()))
+        Augmented = list(streamAugmentations(Augmented, Counter()))
+
+        Forms = [f.canonicalForm() for f in Augmented]
+        assert len(Forms) == len(set(Forms)), "Each class should be augmented once"
+        assert set(Forms) == set(f.canonicalForm() for f in Filtered), \
+            "Augmentation should find the classes of the filtering pipeline"
+
+    counts = Counter()
+    Parallel = nextGenerationParallel([THREE], counts, 2, 1, augment=True)
+    assert Parallel == list(streamAugmentations([THREE], Counter())), \
+        "The parallel augmentation should keep the serial children"
+
+def polymatroidTest0():
+    Extensions = list(streamExtensions(generation4, Counter()))
+    Polys = [Polymatroid.from_conn(f) for f in Extensions]
+
+    assert [Connectivity.from_poly(p) for p in Polys] == Extensions, \
+        "Connectivities should survive the polymatroid round trip"
+    assert filterIsomorphicPolymatroids([]) == [], "Nothing should be left from nothing"
+    for p in Polys:
+        assert p.matchesGraph(p, p.refinedColors(), p.refinedColors()), \
+            "A polymatroid should match its own graph"
+
+    Forms = [f.canonicalForm() for f in streamIsomorphicByPolymatroids(Extensions)]
+    Expected = [f.canonicalForm() for f in filterIsomorphicConnectivities(Extensions)]
+    assert len(Forms) == len(set(Forms)), "Each class should be kept once"
+    assert set(Forms) == set(Expected), "Both engines should keep the same classes"
+
+def flatsTest0():
+    # Closures of six elements are found with NumPy
+    for connectivity in [THREE] + generation4 + generation5 + list(streamExtensions(generation5, Counter())):
+        poly = Polymatroid.from_conn(connectivity)
+        Expected = set(poly.closure(A) for A in poly.subsets)
+
+        assert poly.flats == Expected, str(poly.flats) + " should be " + str(Expected)
+        assert poly.nonflats == set(poly.subsets) - Expected, "Nonflats should be the other subsets"
+        assert [poly.mask(poly.closure(A)) for A in poly.subsets] == \
+            [poly.closures()[m] for m in poly.table.masks], "Closures should agree with closure"
+        assert flatsCut(connectivity).cut == ModularCut(Expected, connectivity).cut, \
+            "flatsCut should be generated by the flats"
+
+def benchTest0():
+    Records = bench.runBenchmarks(4)
+    Stages = set(record["stage"] for record in Records)
+
+    assert all(record.get("ok", True) for record in Records), "Benchmarked counts should be golden"
+    assert {"listCuts", "enumerateCuts", "populateCut", "isomorphicTo",
+            "filterIsomorphicConnectivities"} <= Stages, str(Stages) + " misses stages"
+
+    Baseline = [dict(record, seconds=1.0) for record in Records]
+    Slower = [dict(record, seconds=2.0) for record in Records]
+    assert bench.regressions(Records, Baseline, 1.25) == [], "Faster runs are no regression"
+    assert len(bench.regressions(Slower, Baseline, 1.25)) == len(Records), \
+        "Every stage twice as slow should be a regression"
+
+def instrumentTest0():
+    list(streamIsomorphicConnectivities(streamExtensions(generation4, Counter())))
+    assert instrument.counters == {} and instrument.stages == {}, "Nothing should be recorded when disabled"
+
+    instrument.configure(True)
+    try:
+        list(streamIsomorphicConnectivities(streamExtensions(generation4, Counter())))
+        Recorded = instrument.snapshot()
+        instrument.reset()
+        list(streamIsomorphicByPolymatroids(streamExtensions(generation4, Counter())))
+        Polymatroids = instrument.snapshot()
+    finally:
+        instrument.configure(False)
+
+    assert Recorded["counters"]["closures"] > 0 and Recorded["counters"]["passes"] > 0, \
+        str(Recorded["counters"]) + " should count closures and their passes"
+    assert set(Recorded["stages"]) == {"cuts", "extensions", "filter"}, str(Recorded["stages"]) + " misses stages"
+    assert Recorded["stages"]["cuts"]["counters"]["closures"] == Recorded["counters"]["closures"], \
+        "Closures should be attributed to the cuts stage"
+    assert all((stage["peak_rss_kb"] is None) == (Recorded["peak_rss_kb"] is None)
+               for stage in Recorded["stages"].values()), "Each stage should record the peak RSS"
+    assert Polymatroids["stages"]["filter"]["seconds"] > 0, "The polymatroid engine should be timed as filter"
+
+def parallelTest0():
+    Serial = filterIsomorphicConnectivities(
+        [modularCutExtension(cut, THREE) for cut in unitaryCuts(connectedCuts(enumerateCuts(THREE)))])
+    counts = Counter()
+    Parallel = nextGenerationParallel([THREE, THREE], counts, 2, 1)
+
+    assert counts == {"cuts": 16, "kept": 8}, str(counts) + " should be 16 cuts, 8 kept"
+    assert Parallel == Serial, "The parallel step should keep the serial representatives"
+
+def shardTest0():
+    with tempfile.TemporaryDirectory() as directory:
+        store.writeGeneration(store.generationPath(directory, 4), generation4, 4)
+        assert shard.claimShard(directory, 5, 1, 3), "An unclaimed shard should be claimed"
+        assert shard.work(directory, 5, 3) == [0, 2], "A claimed shard should be left to its worker"
+        try:
+            shard.mergeShards(directory, 5, 3)
+            assert False, "Merging should fail while a shard is not done"
+        except Exception as error:
+            assert "not done" in str(error), str(error)
+        shard.runShard(directory, 5, 1, 3)
+        Merged, counts = shard.mergeShards(directory, 5, 3)
+
+        assert counts["cuts"] == 51, str(counts) + " should find 51 cuts"
+        assert sorted(system.canonicalForm() for system in Merged) == \
+            sorted(system.canonicalForm() for system in generation5), "Shards should merge to the serial classes"
+        assert store.latestGeneration(directory)[0] == 5, "The merge should store the generation"
+
 def isoTest0():
     assert functions[2].isomorphicTo(functions[3]), str(functions[2]) + " should be isomorphic to " \
         + str(functions[3])
@@ -160,6 +561,51 @@ def isoTest3():
     assert not (functions[0].isomorphicTo(functions[3])), str(functions[0]) + " should not be isomorphic to " \
         + str(functions[3])
 
+def isoTest4():
+    # Reversing the labels of the ground set gives an isomorphic function
+    reverse = {0: 3, 1: 2, 2: 1, 3: 0}
+    Relabeled = Connectivity({frozenset(reverse[e] for e in sub): value
+                              for sub, value in functions[1].mapping.items()},
+                             functions[1].groundset)
+    perm = next(functions[1].isomorphisms(Relabeled))
+
+    assert functions[1].isomorphicTo(Relabeled), str(functions[1]) + " should be isomorphic to " \
+        + str(Relabeled)
+    for sub in Relabeled.subsets:
+        image = frozenset(perm[e] for e in sub)
+        assert functions[1].function(image) == Relabeled.function(sub), \
+            str(perm) + " should map " + str(functions[1]) + " onto " + str(Relabeled)
+
+def canonicalTest0():
+    # Canonical forms agree exactly on the isomorphic pairs above
+    assert functions[2].canonicalForm() == functions[3].canonicalForm(), \
+        str(functions[2]) + " and " + str(functions[3]) + " should share a canonical form"
+    assert functions[3].canonicalForm() == functions[4].canonicalForm(), \
+        str(functions[3]) + " and " + str(functions[4]) + " should share a canonical form"
+    assert functions[4].canonicalForm() != functions[5].canonicalForm(), \
+        str(functions[4]) + " and " + str(functions[5]) + " should not share a canonical form"
+    assert functions[0].canonicalForm() != functions[3].canonicalForm(), \
+        str(functions[0]) + " and " + str(functions[3]) + " should not share a canonical form"
+
+    # The form and the labeling come from one search, and are kept
+    Fresh = Connectivity.from_values(functions[5].values, functions[5].groundset)
+    instrument.configure(True)
+    try:
+        Fresh.canonicalForm()
+        Labeling = Fresh.canonicalLabeling()
+        assert Fresh.canonicalLabeling() is Labeling, "The canonical labeling should be kept"
+        Searches = instrument.counters["canonical"]
+    finally:
+        instrument.configure(False)
+    assert Searches == 1, str(Searches) + " canonical searches should be 1"
+
+def fingerprintTest0():
+    assert functions[2].fingerprint() == functions[3].fingerprint(), \
+        str(functions[2]) + " and " + str(functions[3]) + " should share a fingerprint"
+    # Non-isomorphic with different level sizes, so no permutation is tried
+    assert functions[4].fingerprint() != functions[5].fingerprint(), \
+        str(functions[4]) + " and " + str(functions[5]) + " should not share a fingerprint"
+
 def extensionTest0():
     E0 = modularCutExtension(cuts[0], THREE)
     Expected = functions[0]
@@ -203,6 +649,22 @@ def constructionTest3():
     # C3 should be the set containing {0,1} and the ground
     assert cuts[3].cut == Expected, str(cuts[3]) + " should be " + str(Expected)
 
+def constructionTest4():
+    Cuts = listCuts(THREE)
+    Families = set(cut.family for cut in Cuts)
+
+    # Cuts are equal exactly when their families are
+    assert len(set(Cuts)) == len(Families), str(len(set(Cuts))) + " should be " + str(len(Families))
+    assert cuts[0] != cuts[1], str(cuts[0]) + " should not equal " + str(cuts[1])
+    assert ModularCut.from_cut(cuts[2].cut, THREE) == cuts[2], "A cut rebuilt from its sets should be equal"
+    assert not hasattr(cuts[0], "__dict__"), "Cuts should only hold their slots"
+
+    full = THREE.groundset
+    for cut in Cuts:
+        assert cut.isElision() == all(s in cut.cut or full - s in cut.cut for s in THREE.subsets), str(cut)
+        assert cut.isUnitary() == all(full - {e} in cut.cut for e in full), str(cut)
+        assert cut.isConnected() == (frozenset() not in cut.cut), str(cut)
+
     
 if __name__ == "__main__":
     modularCutTest()
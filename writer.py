@@ -0,0 +1,171 @@
+from array import array
+import json
+import os
+import store
+import sys
+
+# Writers stream the functions of a generation out as they are handed over,
+# collecting them into chunks of about BUFFER_SIZE bytes so that each write
+# to the file is a large one. WRITERS names each format and its writer
+
+# Bytes collected before they are written out
+BUFFER_SIZE = 1 << 20
+
+class Writer:
+    """Buffers the chunks written for each function and writes them out in
+       large blocks. Subclasses turn a function into its chunk and may add a
+       header. Writes to standard output when path is None, and otherwise
+       under a temporary name, renamed to path only once closed without an
+       exception, so an interrupted run leaves no partial file behind"""
+
+    extension = ""
+    binary = False
+
+    def __init__(self, path, n):
+        self.path = path
+        self.n = n
+        self.count = 0
+        self.pending = []
+        self.size = 0
+        if path is None:
+            self.out = sys.stdout.buffer if self.binary else sys.stdout
+        else:
+            self.out = open(self.temporaryPath(), "wb" if self.binary else "w")
+        self.begin()
+
+    def temporaryPath(self):
+        return self.path + ".part"
+
+    def begin(self):
+        pass
+
+    def chunk(self, function):
+        raise NotImplementedError
+
+    def write(self, function):
+        chunk = self.chunk(function)
+        self.pending.append(chunk)
+        self.size += len(chunk)
+        self.count += 1
+        if self.size >= BUFFER_SIZE:
+            self.flush()
+
+    def writeAll(self, functions):
+        for function in functions:
+            self.write(function)
+
+    def flush(self):
+        if self.pending:
+            self.out.write((b"" if self.binary else "").join(self.pending))
+            self.pending = []
+            self.size = 0
+
+    def finish(self):
+        """Completes the file before it is renamed"""
+        pass
+
+    def close(self):
+        self.flush()
+        if self.path is None:
+            self.out.flush()
+            return
+        self.finish()
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        self.out.close()
+        os.replace(self.temporaryPath(), self.path)
+
+    def abort(self):
+        """Drops what was written, leaving path as it was"""
+        self.pending = []
+        if self.path is None:
+            self.out.flush()
+            return
+        self.out.close()
+        os.remove(self.temporaryPath())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, exception, traceback):
+        if kind is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+class TextWriter(Writer):
+    """The functions as printed by str, one after another"""
+
+    extension = ".txt"
+
+    def chunk(self, function):
+        return str(function) + "\n"
+
+class JSONLinesWriter(Writer):
+    """A JSON object per line holding |E| and the value vector, indexed by
+       bitmask, of a function"""
+
+    extension = ".jsonl"
+
+    def chunk(self, function):
+        return json.dumps({"n": self.n, "values": list(function.values)}) + "\n"
+
+class BinaryWriter(Writer):
+    """The generation file format of store, readable by readGeneration and
+       mapGeneration. The count in the header is only known once every
+       function is written, so it is filled in on closing, which needs a
+       path. Values are written width bytes wide, and the file is rewritten
+       four bytes wide if a value turns out not to fit"""
+
+    extension = ".bin"
+    binary = True
+
+    def __init__(self, path, n, width=1):
+        self.width = width
+        super().__init__(path, n)
+
+    def begin(self):
+        self.out.write(self.header())
+
+    def header(self):
+        return store.HEADER.pack(store.MAGIC, self.n, self.width,
+                                 self.count).ljust(store.HEADER_SIZE, b"\0")
+
+    def chunk(self, function):
+        try:
+            values = array(store.TYPECODES[self.width], function.values)
+        except OverflowError:
+            self.widen()
+            values = array(store.TYPECODES[self.width], function.values)
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values.tobytes()
+
+    def widen(self):
+        """Rewrites the values written so far four bytes wide"""
+        self.flush()
+        self.out.close()
+        values = array(store.TYPECODES[self.width])
+        with open(self.temporaryPath(), "rb") as source:
+            source.seek(store.HEADER_SIZE)
+            values.fromfile(source, self.count << self.n)
+        if sys.byteorder == "big":
+            values.byteswap()
+        self.width = 4
+        wide = array(store.TYPECODES[self.width], values)
+        if sys.byteorder == "big":
+            wide.byteswap()
+        self.out = open(self.temporaryPath(), "wb")
+        self.out.write(self.header())
+        wide.tofile(self.out)
+
+    def finish(self):
+        self.out.seek(0)
+        self.out.write(self.header())
+
+WRITERS = {"binary": BinaryWriter, "jsonl": JSONLinesWriter, "text": TextWriter}
+
+def outputPath(directory, n, format):
+    """The file the generation with |E| = n is written to in a format"""
+    return os.path.join(directory, "generation" + str(n) + WRITERS[format].extension)